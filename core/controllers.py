@@ -4,12 +4,16 @@ from datetime import datetime, timedelta
 
 import dropbox
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
 from django.utils.timezone import make_aware
 
 from core.models import Company, FulfillmentService
+from db_logger.models import DBLogEntry
 from dropbox_import.models import ImportFile, ExportType, ImportJob
 from interfaces import DropboxInterface, ShopifyInterface
-from .tasks import export_to_shopify
+from .tasks import export_to_shopify, import_products
 
 
 log = logging.getLogger('development')
@@ -33,24 +37,128 @@ class Controller:
         pass
 
     def load_files_from_dropbox(self):
+        """Syncs the ImportFiles with all of the files in Dropbox.
+
+        Returns the numbers of ImportFiles (created, updated, deleted).
+        """
         # list all files in the dropbox export folder
         dropbox_files = dropbox_interface.list_all_files()
-        total_numb_files = len(dropbox_files)
         # TODO: add DB log entry for number of files in dropbox
+        return self.reconcile_import_files(dropbox_files)
+
+    def reconcile_import_files(self, entries):
+        """Creates, updates, and deletes ImportFiles to match the Dropbox
+        entries.
+
+        The companies, export types, and files are each loaded with one query
+        and the missing ones are created in bulk, so the number of queries
+        doesn't grow with the number of files. Only the files whose data
+        changed are updated. ImportFiles for files that aren't in entries
+        are deleted. Returns the numbers of ImportFiles (created, updated,
+        deleted).
+        """
+        files = []
+        for filemeta in entries:
+            # Skip over folders and deleted files
+            if type(filemeta) != dropbox.files.FileMetadata:
+                continue
+            try:
+                company_name, export_type_name = ImportFile.parse_company_export_type(
+                    filemeta.name)
+            except ValueError as e:
+                # skip any files that don't have company and export types
+                log.warning(e)
+                continue
+            files.append((filemeta, company_name, export_type_name))
+
+        with transaction.atomic():
+            companies = self._get_or_create_by_name(
+                Company, {c for f, c, t in files})
+            export_types = self._get_or_create_by_name(
+                ExportType, {t for f, c, t in files})
+            import_files = {
+                f.dropbox_id:f for f in ImportFile.objects.filter(
+                    dropbox_id__in=[f.id for f, c, t in files])}
+
+            new_files = []
+            numb_updated = 0
+            for filemeta, company_name, export_type_name in files:
+                values = {
+                    'path_lower': filemeta.path_lower,
+                    'filename': filemeta.name,
+                    'server_modified': make_aware(filemeta.server_modified, timezone=pytz.UTC),
+                    'content_hash': filemeta.content_hash or '',
+                    'company_id': companies[company_name].id,
+                    'export_type_id': export_types[export_type_name].id,}
+                import_file = import_files.get(filemeta.id)
+                if import_file is None:
+                    new_files.append(
+                        ImportFile(dropbox_id=filemeta.id, **values))
+                elif any(getattr(import_file, k) != v
+                         for k, v in values.items()):
+                    if import_file.content_hash != values['content_hash']:
+                        # The new data hasn't been imported.
+                        values['import_status'] = ImportFile.NOT_IMPORTED
+                    ImportFile.objects.filter(pk=import_file.pk).update(
+                        **values)
+                    numb_updated += 1
+            ImportFile.objects.bulk_create(new_files)
+
+            # Delete ImportFiles that don't exist in Dropbox.
+            numb_deleted, numb_deleted_by_model = ImportFile.objects.exclude(
+                dropbox_id__in=[f.id for f, c, t in files]).delete()
+
+        return (len(new_files), numb_updated,
+                numb_deleted_by_model.get(ImportFile._meta.label, 0))
+
+    def delete_expired_files(self, retention_days=None):
+        """Deletes the files in Dropbox that are older than the retention
+        window along with their ImportFiles, ImportJobs, and log entries.
+
+        The newest file of each company and export type is always kept since
+        later exports are compared with it. Only the rows of the files that
+        Dropbox deleted are removed. Returns the number of files deleted.
+        """
+        if retention_days is None:
+            retention_days = settings.DROPBOX_RETENTION_DAYS
+        cutoff = timezone.now() - timedelta(days=retention_days)
+
+        newer_files = ImportFile.objects.filter(
+            company=OuterRef('company'),
+            export_type=OuterRef('export_type'),
+            server_modified__gt=OuterRef('server_modified'))
+        expired_files = dict(ImportFile.objects.annotate(
+            has_newer=Exists(newer_files)).filter(
+                has_newer=True,
+                server_modified__lt=cutoff).values_list('path_lower', 'id'))
+        if not expired_files:
+            return 0
+
+        deleted_paths = dropbox_interface.delete_files(list(expired_files))
+        ids = [expired_files[p] for p in deleted_paths]
+        with transaction.atomic():
+            DBLogEntry.objects.filter(import_job__import_file__in=ids).delete()
+            ImportJob.objects.filter(import_file__in=ids).delete()
+            ImportFile.objects.filter(id__in=ids).delete()
+
+        log.info('Deleted {} files older than {} days from Dropbox'.format(
+            len(ids), retention_days))
+        return len(ids)
+
+    def _get_or_create_by_name(self, model, names):
+        """Returns a dict of the model instances for names by name, the
+        missing ones are created in bulk."""
+        instances = {
+            x.name:x for x in model.objects.filter(name__in=names)}
+        missing = [model(name=n) for n in names if n not in instances]
+        if missing:
+            model.objects.bulk_create(missing)
+            # Not every database sets the ids with bulk_create.
+            instances.update({
+                x.name:x for x in model.objects.filter(
+                    name__in=[x.name for x in missing])})
+        return instances
 
-        # Delete files in DB that are not in Dropbox.
-        # Create a list of dropbox file ids.
-        filemeta_ids = [ filemeta.id for filemeta in dropbox_files]
-        # Delete ImportFiles that don't exist in Dropbox.
-        numb_deleted, numb_deleted_by_model = ImportFile.objects.exclude(
-            dropbox_id__in=filemeta_ids).delete()
-        # TODO: Log the number of ImportFiles deleted.
-
-        for filemeta in dropbox_files:
-            # TODO: collect the returned results
-            self.process_dropbox_filemeta(filemeta)
-            pass
-        
     def process_dropbox_filemeta(self, filemeta):
 
         # TODO: return the results of the processing
@@ -60,9 +168,9 @@ class Controller:
             return
             
         elif type(filemeta) == dropbox.files.DeletedMetadata:
-            # Remove the local ImportFile.
-            ImportFile.objects.get(path_lower=filemeta.path_lower).delete()
-            pass
+            # Remove the local ImportFile, it's already gone if the file was
+            # deleted by delete_expired_files.
+            ImportFile.objects.filter(path_lower=filemeta.path_lower).delete()
 
         elif type(filemeta) == dropbox.files.FileMetadata:
             # create or update model instances
@@ -101,6 +209,7 @@ class Controller:
                         'path_lower': filemeta.path_lower,
                         'filename': filemeta.name,
                         'server_modified': make_aware(filemeta.server_modified, timezone=pytz.UTC),
+                        'content_hash': filemeta.content_hash or '',
                         'company': company,
                         'export_type': export_type,})
             except ValueError as e:
@@ -121,27 +230,28 @@ class Controller:
 
         - List the changed files
           - Check for a cursor, This is created during app initialization.
-          - If no cursor then raise exception
-          - Handle exception and re-init app.
-            - We don't know what files were changed so we can't import them.
+          - If there is no cursor, list all of the files instead and
+            export the newest ones that haven't been imported.
         - Process each file
           - Create Company, ExportType if needed.
         - Add new ImportFiles and start ImportJob in a celery task.
         - Delete old files from dropbox and their associated ImportFiles
         - Delete ImportFiles if they have been deleted on dropbox manually
 
-        Note:  This function NEEDS to complete within 10 seconds so that the
-        calling function can reply with a HTTP 200 response to Dropbox. Avoid
-        extra network calls were possible. Only communicate with dropbox api.
+        Note: This is run by the handle_dropbox_changes celery task, the
+        webhook view only queues the task so it can reply to Dropbox with a
+        HTTP 200 response within 10 seconds.
         """
 
         try:
             changed_files = dropbox_interface.list_changed_files()
         except RuntimeError as e:
-            # run startup to reinitialize the app
-            self.startup()
-            # raise to catch and log the exception further up.
-            raise
+            # Without a cursor the changes can't be listed, like after the
+            # cursor was reset. The whole folder is listed instead so the
+            # changes aren't lost.
+            log.warning('Missing Dropbox cursor, listing all of the files.')
+            self.export_missed_files()
+            return
 
         # process each changed file
         for filemeta in changed_files:
@@ -152,24 +262,63 @@ class Controller:
                 if isinstance(ret_val, ImportFile):
                     self.start_shopify_export(ret_val.id)
 
-    def start_shopify_export(self, import_file_id):
+    def export_missed_files(self):
+        """Syncs the ImportFiles with all of the files in Dropbox and exports
+        the ones that haven't been imported.
+
+        Only the newest file of each company and export type is exported, the
+        same as when the changes are listed. Returns the number of exports
+        started.
+        """
+        self.load_files_from_dropbox()
+        newer_files = ImportFile.objects.filter(
+            company=OuterRef('company'),
+            export_type=OuterRef('export_type'),
+            server_modified__gt=OuterRef('server_modified'))
+        files = ImportFile.objects.annotate(
+            has_newer=Exists(newer_files)).filter(
+                has_newer=False,
+                import_status=ImportFile.NOT_IMPORTED)
+
+        numb_started = 0
+        for file in files:
+            if file.is_importing():
+                continue
+            self.start_shopify_export(file.id)
+            numb_started += 1
+        return numb_started
+
+    def start_shopify_export(self, import_file_id, force=False):
         """Imports Dropbox data file and then exports to Shopify.
+
+        The export is skipped if the file has the same content as the last
+        exported file for the company, unless force is True.
         """
 
         log.debug('start_shopify_export()')
         # get the import file
         file = ImportFile.objects.get(pk=import_file_id)
 
-        # Skip Product Exports
-        if file.export_type == 'Product':
-            log.debug('Skipping Product export file.')
-            return
+        # Product files are only imported, the variants aren't exported to
+        # Shopify.
+        if file.export_type.name == 'Product':
+            job_task = import_products
+        else:
+            job_task = export_to_shopify
+
+        # Only the newest file for a company and export type is exported.
+        if not force and file.is_superseded():
+            file.import_status = ImportFile.EXPIRED
+            file.save()
+            return 'Skipped {}, there is a newer file for company "{}"'.format(
+                file.filename, file.company)
+        file.supersede_older_files()
 
         # Create an ImportJob for this file
         job = ImportJob.objects.create(import_file=file)
         # try to start celery task
         try:
-            job.start(job_task=export_to_shopify)
+            job.start(job_task=job_task, extra={'force': force})
         except Exception as e:
             # There was an error starting the celery task
             raise
@@ -177,69 +326,6 @@ class Controller:
         return 'Export job started successfully or company "{}"'.format(
             file.company)
 
-    def get_import_data(self):
-        """Fetch import files from dropbox
-
-        This is a new function and is not currently being used. Should replace
-        load_import_files() when ready.
-        """
-        entries = self.dropbox_interface.list_files(
-            settings.DROPBOX_EXPORT_FOLDER)
-
-        # get current datetime
-        now = datetime.now()
-        expiry_date = now + timedelta(-7)
-        recent_files = []
-        import_metadata = {}
-
-        for e in entries:
-            # skip non-files
-            if type(e) != dropbox.files.FileMetadata:
-                continue
-
-            # delete files older than 2 weeks
-            if e.server_modified < expiry_date:
-                self.dropbox_interface.delete_file(e.path_lower)
-
-            else:
-                recent_files.append(e)
-
-
-        # sort the recent files by company then by filetype
-        # only save the most recent file of each
-        for e in recent_files:
-            # parse the filename for company and export type
-            c, t = self.dropbox_interface.parse_company_export_type(e.name)
-
-            # create the company and type keys if they don't exist
-            if c not in import_metadata:
-                # initialize the keys and save the entry
-                import_metadata[c] = {t: e}
-                # first time this key has been seen
-                continue
-
-            if t not in import_metadata[c]:
-                # initialize the keys and save the entry
-                import_metadata[c][t] = e
-                # first time this key has been seen
-                continue
-
-            # check for a file in the import_metadata spot already
-            if import_metadata[c][t].server_modified < e.server_modified:
-                import_metadata[c][t] = e
-
-
-        for c, _type in import_metadata.items():
-            pprint(c)
-            for t, e in _type.items():
-                pprint(t)
-                pprint(e.name)
-                pprint(str(e.server_modified))
-
-        # pprint(import_metadata)
-        # get the last 2 weeks of file metadata
-        # delete files on dropbox older than a month
-
     def _get_companies_or_none(self, names=None):
         if names:
             try:
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.controllers import Controller
+from interfaces import DropboxInterface
+
+
+class Command(BaseCommand):
+    help = ('Watches the Dropbox export folder and processes the changed '
+            'files as they happen. An alternative to the Dropbox webhook.')
+
+    def handle(self, *args, **options):
+        controller = Controller()
+        dropbox_interface = DropboxInterface()
+
+        self.stdout.write('Watching {} for changes.'.format(
+            settings.DROPBOX_EXPORT_FOLDER))
+        try:
+            dropbox_interface.watch_changes(
+                controller.handle_dropbox_file_change_notification)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped watching for changes.')
@@ -1,4 +1,6 @@
-import logging
+import logging, time
+from collections import namedtuple
+from contextlib import contextmanager
 from django.db import models
 from datetime import timedelta
 from pprint import pprint, pformat
@@ -59,6 +61,8 @@ class Company(models.Model):
                 self.shopify_url_is_valid = False
             else:
                 self.shopify_url_is_valid = True
+                # Don't keep a catalog cached with the old credentials.
+                shop.invalidate_cache()
 
         super().save(*args, **kwargs)
         # populate the fulfillment services for this company, called after the
@@ -100,6 +104,19 @@ class RedisModel:
     """
     Model for storing sets of objects in Redis
 
+    Items are written to a snapshot that is staged under its own version
+    number and only becomes visible to readers once it is published. Publishing
+    swaps the 'current' version pointer so readers always see a complete set
+    of items. Replaced snapshots are reclaimed with UNLINK after a grace period
+    so readers that already resolved the old version can finish.
+
+    <namespace>:version - counter used to number the snapshots
+    <namespace>:current - version of the published snapshot
+    <namespace>:exported - version of the last successfully exported snapshot
+    <namespace>:retired - sorted set of replaced versions to reclaim
+    <namespace>:<version>:<item_set_key> - set of the item keys
+    <namespace>:<version>:<item_key_prefix>:<key> - hash of each item
+
     python redis methods to use
     .hget(name, key) - returns value for hash key
     .hgetall(name) - returns dict
@@ -108,25 +125,181 @@ class RedisModel:
     .expire(name, seconds) - seconds can be an integer or timedelta obj.
     .sadd(name, value) - add value to set
     """
+    # Number of items buffered by batch_writes() before they are sent to Redis.
+    batch_size = 500
+    # Number of keys sent with each UNLINK when reclaiming a snapshot.
+    unlink_batch_size = 1000
+    # Time a replaced snapshot is kept for readers before it is reclaimed.
+    snapshot_grace_period = timedelta(minutes=5)
+    # Snapshot keys expire in case they are never published or reclaimed.
+    snapshot_expiry = timedelta(hours=12)
+
     def __init__(self):
         self.redis = RedisInterface()
         self.items = dict()
         self.item_key_set = set()
+        self.write_version = None
+        self._pipeline = None
+        self._numb_buffered = 0
 
     def add_item(self, key, item):
         self.items[key] = item
         self.item_key_set.add(key)
 
+        # Items are always added to the staged snapshot.
+        if self.write_version is None:
+            self.begin_snapshot()
+
+        # Inside batch_writes() the commands are queued on the pipeline.
+        if self._pipeline is not None:
+            client = self._pipeline
+        else:
+            client = self.redis.client
+
         # add key to redis set
-        self.redis.client.sadd(self.item_set_key_name, key)
+        set_key = self._format_item_set_key(self.write_version)
+        client.sadd(set_key, key)
+        client.expire(set_key, self.snapshot_expiry)
 
         # add item hash to redis
-        key = self._format_item_key(key)
-        self.redis.client.hmset(key, item)
-        self.redis.client.expire(key, timedelta(hours=12))
+        key = self._format_item_key(key, self.write_version)
+        client.hmset(key, item)
+        client.expire(key, self.snapshot_expiry)
+
+        if self._pipeline is not None:
+            self._numb_buffered += 1
+            if self._numb_buffered >= self._batch_size:
+                self.flush()
+
+    @contextmanager
+    def batch_writes(self, size=None):
+        """Buffers add_item() calls and writes them through a Redis pipeline.
+
+        The buffered commands are sent every `size` items and when the block
+        exits. Nothing more is sent if the block raises.
+
+        with inventory.batch_writes():
+            for row in rows:
+                inventory.add_item(row['UPC'], row)
+        """
+        self._batch_size = size or self.batch_size
+        self._pipeline = self.redis.client.pipeline(transaction=False)
+        self._numb_buffered = 0
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._pipeline = None
+
+    def flush(self):
+        """Sends the items buffered by batch_writes() to Redis."""
+        if self._pipeline is None:
+            return
+        self._pipeline.execute()
+        self._numb_buffered = 0
+
+    # Snapshots ###############################################################
+
+    def begin_snapshot(self):
+        """Starts a new staged snapshot that add_item() writes to.
+
+        Also reclaims any replaced snapshots whose grace period is over.
+        """
+        self.reclaim_snapshots()
+        self.write_version = self.redis.client.incr(
+            self.redis.format_key('version'))
+        return self.write_version
+
+    def publish_snapshot(self):
+        """Makes the staged snapshot the one readers see.
+
+        The version pointer is swapped in one command so readers never see a
+        partial snapshot. The replaced snapshot is retired for reclaiming.
+        """
+        if self.write_version is None:
+            raise ValueError('No staged snapshot to publish.')
+        self.flush()
+
+        old_version = self.redis.client.getset(
+            self.redis.format_key('current'), self.write_version)
+        if old_version is not None:
+            self._retire_snapshot(int(old_version))
+
+        version = self.write_version
+        self.write_version = None
+        return version
+
+    def discard_snapshot(self):
+        """Retires the staged snapshot when it won't be published."""
+        if self.write_version is None:
+            return
+        self._retire_snapshot(self.write_version)
+        self.write_version = None
+
+    def mark_exported(self, version):
+        """Keeps the snapshot as the last one successfully exported.
+
+        The previously exported snapshot is retired.
+        """
+        old_version = self.redis.client.getset(
+            self.redis.format_key('exported'), version)
+        if old_version is not None and int(old_version) != version:
+            self._retire_snapshot(int(old_version))
+
+    def get_current_version(self):
+        """Returns the published snapshot version or None."""
+        return self._get_version('current')
+
+    def get_exported_version(self):
+        """Returns the last exported snapshot version or None."""
+        return self._get_version('exported')
+
+    def has_snapshot(self, version):
+        """Returns True if the snapshot's items are still in Redis."""
+        return bool(self.redis.client.exists(
+            self._format_item_set_key(version)))
+
+    def _get_version(self, name):
+        version = self.redis.client.get(self.redis.format_key(name))
+        if version is None:
+            return None
+        return int(version)
+
+    def reclaim_snapshots(self, grace_period=None):
+        """Deletes the retired snapshots that are past their grace period."""
+        if grace_period is None:
+            grace_period = self.snapshot_grace_period
+        retired_key = self.redis.format_key('retired')
+        cutoff = time.time() - grace_period.total_seconds()
+        # A retired snapshot may still be the current or exported one. It is
+        # retired again when it is replaced there.
+        in_use = (self.get_current_version(), self.get_exported_version())
+        for version in self.redis.client.zrangebyscore(
+                retired_key, '-inf', cutoff):
+            if int(version) not in in_use:
+                self._unlink_snapshot(int(version))
+            self.redis.client.zrem(retired_key, version)
+
+    def _retire_snapshot(self, version):
+        self.redis.client.zadd(
+            self.redis.format_key('retired'), time.time(), version)
+
+    def _unlink_snapshot(self, version):
+        # UNLINK frees the memory in a background thread on the Redis server.
+        set_key = self._format_item_set_key(version)
+        keys = []
+        for k in self.redis.client.sscan_iter(
+                set_key, count=self.unlink_batch_size):
+            keys.append(self._format_item_key(k.decode('utf-8'), version))
+            if len(keys) >= self.unlink_batch_size:
+                self.redis.client.execute_command('UNLINK', *keys)
+                keys = []
+        self.redis.client.execute_command('UNLINK', set_key, *keys)
+
+    # Reading #################################################################
 
     def get_item(self, key):
-        key = self._format_item_key(key)
+        key = self._format_item_key(key, self.get_current_version())
         item = self.redis.client.hgetall(key)
         return {
             k.decode('utf-8'): v.decode('utf-8')
@@ -134,7 +307,7 @@ class RedisModel:
         }
 
     def get_item_value(self, key, prop):
-        key = self._format_item_key(key)
+        key = self._format_item_key(key, self.get_current_version())
         value = self.redis.client.hget(key, prop)
         try:
             return value.decode('utf-8')
@@ -142,22 +315,60 @@ class RedisModel:
             log.exception(e)
             log.warning('Unable to decode value: {} for prop: {}, key: {}'.format(value, prop, key))
 
-    def _format_item_key(self, key):
-        return self.redis.format_key(self.item_key_prefix, key)
+    def get_item_values(self, prop, version=None):
+        """Returns a dict of item key to the value of prop for every item.
+
+        Reads the published snapshot unless a version is passed. All of the
+        values are fetched in a single pipelined round trip. Items without the
+        prop are left out.
+        """
+        if version is None:
+            version = self.get_current_version()
+        if version is None:
+            return dict()
+
+        keys = [k.decode('utf-8') for k in
+                self.redis.client.smembers(self._format_item_set_key(version))]
+        pipe = self.redis.client.pipeline(transaction=False)
+        for k in keys:
+            pipe.hget(self._format_item_key(k, version), prop)
+        values = pipe.execute()
+        return {
+            k: v.decode('utf-8')
+            for k, v in zip(keys, values)
+            if v is not None
+        }
+
+    def _format_item_key(self, key, version):
+        return self.redis.format_key(version, self.item_key_prefix, key)
+
+    def _format_item_set_key(self, version):
+        return self.redis.format_key(version, self.item_set_key)
 
     def _save_item_set_key(self, key):
-        self.item_set_key_name = self.redis.format_key(key)
+        self.item_set_key = key
 
     def reset(self):
-        # delete the key set
-        self.redis.client.delete(self.item_set_key_name)
+        """Deletes the published, exported, staged, and retired snapshots."""
+        for name in ('current', 'exported'):
+            version = self._get_version(name)
+            self.redis.client.delete(self.redis.format_key(name))
+            if version is not None:
+                self._retire_snapshot(version)
+        if self.write_version is not None:
+            self._retire_snapshot(self.write_version)
+            self.write_version = None
+        self.reclaim_snapshots(grace_period=timedelta(0))
+
+InventoryDiff = namedtuple('InventoryDiff', ['added', 'removed', 'changed'])
 
-        # delete all the item hashes
-        m = self._format_item_key('*')
-        for k in self.redis.client.scan_iter(match=m):
-            self.redis.client.delete(k)
 
 class Inventory(RedisModel):
+    # The exported snapshot is kept between imports for delta exports.
+    snapshot_expiry = timedelta(days=2)
+    # Longest time an export can hold the export lock.
+    export_lock_timeout = timedelta(hours=1)
+
     def __init__(self, company_name):
         super().__init__()
         # set key prefix to 'CompanyName:inventory'
@@ -169,3 +380,81 @@ class Inventory(RedisModel):
 
         # name the item key prefix
         self.item_key_prefix = 'upc'
+
+    def get_quantities(self, version=None):
+        """Returns a dict of every UPC to its quantity."""
+        quantities = dict()
+        for upc, quantity in self.get_item_values('QUANTITY', version).items():
+            try:
+                quantities[upc] = int(quantity)
+            except ValueError:
+                log.warning('Unable to cast quantity value: {} to int for upc: {}'
+                            .format(quantity, upc))
+                quantities[upc] = 0
+        return quantities
+
+    def get_exported_quantities(self):
+        """Returns the quantities of the last exported snapshot.
+
+        Returns None if nothing has been exported or the snapshot has expired.
+        """
+        version = self.get_exported_version()
+        if version is None or not self.has_snapshot(version):
+            return None
+        return self.get_quantities(version)
+
+    def export_lock(self):
+        """Returns a Redis lock held while a snapshot is published and
+        exported, so the exports for a company run one at a time.
+
+        with inventory.export_lock():
+            inventory.publish_snapshot()
+        """
+        return self.redis.client.lock(
+            self.redis.format_key('export_lock'),
+            timeout=self.export_lock_timeout.total_seconds())
+
+    def mark_full_sync(self):
+        """Records the time of a full export of every variant."""
+        self.redis.client.set(self.redis.format_key('full_sync'), time.time())
+
+    def needs_full_sync(self, interval):
+        """Returns True if the last full export was longer than interval ago.
+        """
+        last_sync = self.redis.client.get(self.redis.format_key('full_sync'))
+        if last_sync is None:
+            return True
+        return time.time() - float(last_sync) > interval.total_seconds()
+
+    @staticmethod
+    def diff(old_quantities, new_quantities):
+        """Returns the UPCs that were added, removed, or changed quantity."""
+        old_upcs = set(old_quantities)
+        new_upcs = set(new_quantities)
+        return InventoryDiff(
+            added=new_upcs - old_upcs,
+            removed=old_upcs - new_upcs,
+            changed={
+                upc for upc in old_upcs & new_upcs
+                if old_quantities[upc] != new_quantities[upc]})
+
+
+class ProductVariants(RedisModel):
+    """The variants of the last imported Product file keyed by UPC.
+
+    Each item is a hash of the STYLE NUMBER, COLOR CODE, and SIZE of the
+    variant.
+    """
+
+    # Product files are exported less often than inventory, the snapshot is
+    # kept until the next one is imported.
+    snapshot_expiry = timedelta(days=7)
+
+    def __init__(self, company_name):
+        super().__init__()
+        # set key prefix to 'CompanyName:products'
+        self.redis.add_namespace(company_name)
+        self.redis.add_namespace('products')
+
+        self._save_item_set_key('upcs')
+        self.item_key_prefix = 'upc'
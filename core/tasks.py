@@ -3,12 +3,16 @@ from pprint import pprint, pformat
 
 from celery import shared_task
 from celery.signals import worker_ready, worker_shutdown
+from django.conf import settings
+from redis.exceptions import LockError
 
 import db_logger
 from dropbox_import.models import ImportFile, ImportJob
-from core.models import Company, FulfillmentService
-from csv_parser.models import CSVRows
-from dropbox_import.importers import InventoryImporter
+from core.models import Company, FulfillmentService, ProductVariants
+from csv_parser import columnar
+from csv_parser.models import CSVRows, ProductVariantRows
+from csv_parser.parallel import ParallelCSVRows
+from dropbox_import.importers import InventoryImporter, ProductImporter
 from dropbox_import.exporters import InventoryExporter
 from interfaces import ShopifyInterface, DropboxInterface
 
@@ -19,9 +23,10 @@ dropbox_interface = DropboxInterface()
 
 
 @shared_task(bind=True)
-def export_to_shopify(self, import_job_id):
+def export_to_shopify(self, import_job_id, force=False):
     log.debug(
-        'export_to_shopify(import_job_id={})'.format(import_job_id))
+        'export_to_shopify(import_job_id={}, force={})'.format(
+            import_job_id, force))
 
     dblog.info(
         'Celery task started export_to_shopify(import_job_id={})'.format(
@@ -35,6 +40,20 @@ def export_to_shopify(self, import_job_id):
     # put the company in a variable for quick access
     company = job.import_file.company
 
+    if not force and file.is_superseded():
+        _supersede(job, file)
+        return True
+
+    # Nothing to do if the data hasn't changed since the last export, like
+    # when the same file is uploaded again.
+    if not force and file.is_content_exported():
+        dblog.info(
+            'Skipped export, {} has the same content as the last exported '
+            'file.'.format(file.filename), import_job_id)
+        file.import_status = ImportFile.IMPORTED
+        file.save()
+        return True
+
     try:
         import_fulfillment_service = FulfillmentService.objects.get(
             is_import_destination=True,
@@ -52,24 +71,113 @@ def export_to_shopify(self, import_job_id):
         shop_url=company.shop_url,
         fulfillment_service_id=import_fulfillment_service.service_id)
 
-    # download the file
-    filemeta, response = dropbox_interface.download_file(
-        file.dropbox_id)
-
-    # TODO: Capture the file format errors from CSVRows and add them to the
-    # ImportJob log entries.
-    rows = CSVRows(response.content,
-                   file.export_type.name)
+    if (file.export_type.name == 'Inventory'
+            and settings.CSV_COLUMNAR_INVENTORY):
+        # The columns are parsed from the whole file, download it first.
+        # Retries use the copy in the file cache.
+        path = dropbox_interface.download_to_cache(
+            file.dropbox_id, file.content_hash)
+        rows = columnar.InventoryColumns.from_file(path)
+    else:
+        # The rows are parsed as the file is downloaded, it is written to the
+        # file cache at the same time for retries.
+        rows = CSVRows(
+            dropbox_interface.download_chunks(
+                file.dropbox_id, file.content_hash),
+            file.export_type.name,
+            columns=InventoryImporter.columns)
+    # The rows are staged while other jobs for the company may be exporting.
     importer = InventoryImporter(company=company,
-                                 rows=rows)
-    importer.import_data()
-
-    exporter = InventoryExporter(
-        company=company,
-        fulfillment_service_id=import_fulfillment_service.service_id)
+                                 rows=rows,
+                                 publish=False)
     try:
-        exporter.export_data()
-    except Exception as e:
-        log.exception(e)
+        importer.import_data()
+        # The rows with invalid data are logged once for the whole file.
+        if rows.errors:
+            dblog.warning(rows.errors.summary(), import_job_id)
+
+        # Exports for a company run one at a time so an older file can't
+        # overwrite the data from a newer one. A job that was superseded
+        # while it was importing stops here.
+        lock = importer.inventory.export_lock()
+        lock.acquire()
+        try:
+            if not force and file.is_superseded():
+                _supersede(job, file)
+                return True
+            importer.publish()
+
+            exporter = InventoryExporter(
+                company=company,
+                fulfillment_service_id=import_fulfillment_service.service_id,
+                shop=shop)
+            # A failed export fails the job, so the file's content isn't
+            # taken as exported by is_content_exported().
+            exporter.export_data()
+        finally:
+            try:
+                lock.release()
+            except LockError:
+                log.warning('Inventory export lock expired during export.')
+    finally:
+        # The snapshot of a superseded or failed job is never published.
+        importer.discard()
+
+    file.import_status = ImportFile.IMPORTED
+    file.save()
+    return True
+
+
+@shared_task(bind=True)
+def import_products(self, import_job_id, force=False):
+    """Imports the variants of a Product file to Redis."""
+    log.debug(
+        'import_products(import_job_id={}, force={})'.format(
+            import_job_id, force))
+
+    job = ImportJob.objects.get(pk=import_job_id)
+    file = job.import_file
 
+    if not force and file.is_superseded():
+        _supersede(job, file)
+        return True
+
+    # The same content is imported again once its snapshot has expired.
+    products = ProductVariants(file.company.name)
+    current = products.get_current_version()
+    if (not force and file.is_content_exported()
+            and current is not None and products.has_snapshot(current)):
+        dblog.info(
+            'Skipped import, {} has the same content as the last imported '
+            'file.'.format(file.filename), import_job_id)
+        file.import_status = ImportFile.IMPORTED
+        file.save()
+        return True
+
+    # The parts of the file are parsed in a pool of processes, download it
+    # first. Retries use the copy in the file cache.
+    path = dropbox_interface.download_to_cache(
+        file.dropbox_id, file.content_hash)
+    variants = ProductVariantRows(ParallelCSVRows(
+        path, 'Product', columns=ProductVariantRows.columns,
+        workers=settings.CSV_PARALLEL_WORKERS))
+    importer = ProductImporter(company=file.company, rows=variants)
+    try:
+        importer.import_data()
+    finally:
+        # The snapshot of a failed import is never published.
+        importer.discard()
+    if variants.errors:
+        dblog.warning(variants.errors.summary(), import_job_id)
+
+    file.import_status = ImportFile.IMPORTED
+    file.save()
     return True
+
+
+def _supersede(job, file):
+    """Stops a job because there is a newer file to export."""
+    file.import_status = ImportFile.EXPIRED
+    file.save()
+    job.supersede('Skipped export, there is a newer file than {}.'.format(
+        file.filename))
@@ -1,3 +1,379 @@
-from django.test import TestCase
+import os, tempfile
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import dropbox
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from db_logger.models import DBLogEntry
+from dropbox_import.models import ExportType, ImportFile, ImportJob
+from .controllers import Controller, dropbox_interface
+from .models import Company, FulfillmentService, Inventory, ProductVariants
+from .tasks import export_to_shopify, import_products
+
+
+class InventoryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.inventory = Inventory('TestingCompany')
+        self.inventory.reset()
+
+    def tearDown(self):
+        self.inventory.reset()
+
+    def test_batch_writes(self):
+        upcs = ['638700000001', '638700000002', '638700000003']
+        version = self.inventory.begin_snapshot()
+        with self.inventory.batch_writes(size=2):
+            for i, upc in enumerate(upcs):
+                self.inventory.add_item(upc, {'UPC': upc, 'QUANTITY': i})
+            # The first two items have been flushed, the last is buffered.
+            self.assertEqual(
+                self.inventory.get_item_values('QUANTITY', version),
+                {upcs[0]: '0', upcs[1]: '1'})
+
+        self.assertEqual(
+            len(self.inventory.get_item_values('QUANTITY', version)), 3)
+
+    def test_get_quantities(self):
+        self.inventory.add_item('638700000001', {'QUANTITY': 4})
+        self.inventory.add_item('638700000002', {'QUANTITY': 'bogus'})
+        self.inventory.add_item('638700000003', {'DATE': 'IMMEDIATE'})
+        self.inventory.publish_snapshot()
+        self.assertEqual(self.inventory.get_quantities(), {
+            '638700000001': 4,
+            '638700000002': 0,})
+
+    def test_publish_snapshot(self):
+        self.inventory.add_item('638700000001', {'QUANTITY': 1})
+        first = self.inventory.publish_snapshot()
+
+        # Staged items are not visible until they are published.
+        self.inventory.begin_snapshot()
+        self.inventory.add_item('638700000002', {'QUANTITY': 2})
+        self.assertEqual(self.inventory.get_quantities(),
+                         {'638700000001': 1})
+
+        second = self.inventory.publish_snapshot()
+        self.assertEqual(self.inventory.get_current_version(), second)
+        self.assertEqual(self.inventory.get_quantities(),
+                         {'638700000002': 2})
+
+        # The replaced snapshot is kept for its grace period.
+        self.inventory.reclaim_snapshots()
+        self.assertEqual(
+            self.inventory.get_item_values('QUANTITY', first),
+            {'638700000001': '1'})
+        self.inventory.reclaim_snapshots(grace_period=timedelta(0))
+        self.assertEqual(
+            self.inventory.get_item_values('QUANTITY', first), {})
+
+    def test_exported_snapshot(self):
+        self.assertIsNone(self.inventory.get_exported_quantities())
+        self.inventory.add_item('638700000001', {'QUANTITY': 1})
+        self.inventory.add_item('638700000002', {'QUANTITY': 2})
+        first = self.inventory.publish_snapshot()
+        self.inventory.mark_exported(first)
+
+        self.inventory.begin_snapshot()
+        self.inventory.add_item('638700000002', {'QUANTITY': 5})
+        self.inventory.add_item('638700000003', {'QUANTITY': 3})
+        self.inventory.publish_snapshot()
+
+        # The exported snapshot is not reclaimed while it is still in use.
+        self.inventory.reclaim_snapshots(grace_period=timedelta(0))
+        exported = self.inventory.get_exported_quantities()
+        self.assertEqual(exported, {'638700000001': 1, '638700000002': 2})
+
+        diff = Inventory.diff(exported, self.inventory.get_quantities())
+        self.assertEqual(diff.added, {'638700000003'})
+        self.assertEqual(diff.removed, {'638700000001'})
+        self.assertEqual(diff.changed, {'638700000002'})
+
+    def test_discard_snapshot(self):
+        version = self.inventory.begin_snapshot()
+        self.inventory.add_item('638700000001', {'QUANTITY': 1})
+        self.inventory.discard_snapshot()
+        self.assertIsNone(self.inventory.write_version)
+        self.inventory.reclaim_snapshots(grace_period=timedelta(0))
+        self.assertFalse(self.inventory.has_snapshot(version))
+
+    def test_needs_full_sync(self):
+        self.inventory.redis.client.delete(
+            self.inventory.redis.format_key('full_sync'))
+        self.assertTrue(self.inventory.needs_full_sync(timedelta(hours=1)))
+        self.inventory.mark_full_sync()
+        self.assertFalse(self.inventory.needs_full_sync(timedelta(hours=1)))
+
+    def test_export_lock(self):
+        with self.inventory.export_lock():
+            other = Inventory('TestingCompany').export_lock()
+            self.assertFalse(other.acquire(blocking=False))
+        self.assertTrue(other.acquire(blocking=False))
+        other.release()
+
+
+def filemeta(i, company='Theia', export_type='Inventory', content_hash=None):
+    name = '2018110100{:04d}.SHPFY_{}Extract_{}.CSV'.format(
+        i, export_type, company)
+    return dropbox.files.FileMetadata(
+        name=name, id='id:{}'.format(i), path_lower='/' + name.lower(),
+        server_modified=datetime(2018, 11, 1), content_hash=content_hash)
+
+
+class ControllerTest(TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+
+    def reconcile(self, entries):
+        with CaptureQueriesContext(connection) as queries:
+            result = self.controller.reconcile_import_files(entries)
+        return result, len(queries)
+
+    def test_reconcile_import_files(self):
+        Company.objects.create(name='Theia')
+        entries = [filemeta(i, company) for i, company in
+                   enumerate(['Theia', 'Shop', 'Bridal'] * 2)]
+        entries.append(dropbox.files.FolderMetadata(
+            name='folder', id='id:folder', path_lower='/folder'))
+        entries.append(filemeta(99, export_type='bogus.txt'))
+
+        result, numb_queries = self.reconcile(entries)
+        self.assertEqual(result, (6, 0, 0))
+        self.assertEqual(ImportFile.objects.count(), 6)
+        self.assertEqual(
+            set(Company.objects.values_list('name', flat=True)),
+            {'Theia', 'Shop', 'Bridal'})
+        self.assertEqual(
+            ImportFile.objects.get(dropbox_id='id:1').company.name, 'Shop')
+
+        # One file changed and one removed.
+        ImportFile.objects.update(import_status=ImportFile.IMPORTED)
+        entries[0] = filemeta(0, content_hash='a' * 64)
+        result, numb_queries = self.reconcile(entries[:5])
+        self.assertEqual(result, (0, 1, 1))
+        changed = ImportFile.objects.get(dropbox_id='id:0')
+        self.assertEqual(changed.content_hash, 'a' * 64)
+        # The new data needs to be imported.
+        self.assertEqual(changed.import_status, ImportFile.NOT_IMPORTED)
+
+    def test_constant_queries(self):
+        result, few = self.reconcile([filemeta(i) for i in range(2)])
+        result, many = self.reconcile(
+            [filemeta(i, 'Company' + 'ABCDE'[i % 5]) for i in range(50)])
+        self.assertEqual(result, (48, 2, 0))
+        self.assertLessEqual(many, few + 2)
+
+    def test_missing_cursor(self):
+        # A file was exported before the cursor was reset.
+        self.reconcile([filemeta(1, content_hash='a' * 64)])
+        ImportFile.objects.update(import_status=ImportFile.IMPORTED)
+        # Files added while there was no cursor.
+        entries = [filemeta(i, content_hash='a' * 64) for i in range(1, 4)]
+        for i, e in enumerate(entries):
+            e.server_modified = datetime(2018, 11, 1, i)
+        entries.append(filemeta(4, company='Shop'))
+
+        with mock.patch.object(dropbox_interface, 'list_changed_files',
+                               side_effect=RuntimeError), \
+                mock.patch.object(dropbox_interface, 'list_all_files',
+                                  return_value=entries), \
+                mock.patch.object(self.controller,
+                                  'start_shopify_export') as start:
+            self.controller.handle_dropbox_file_change_notification()
+
+        # The newest file of each company is exported.
+        exported = {ImportFile.objects.get(pk=c[0][0]).dropbox_id
+                    for c in start.call_args_list}
+        self.assertEqual(exported, {'id:3', 'id:4'})
+
+    def test_start_product_import(self):
+        file = ImportFile.objects.create(
+            dropbox_id='id:0', path_lower='/0.csv', filename='0.csv',
+            company=Company.objects.create(name='Theia'),
+            export_type=ExportType.objects.create(name='Product'),
+            server_modified=timezone.now())
+        with mock.patch.object(ImportJob, 'start') as start:
+            self.controller.start_shopify_export(file.pk)
+        self.assertIs(start.call_args[1]['job_task'], import_products)
+
+    def test_delete_expired_files(self):
+        company = Company.objects.create(name='Theia')
+        export_type = ExportType.objects.create(name='Inventory')
+        now = timezone.now()
+        files = []
+        for i, days in enumerate([30, 20, 15, 1]):
+            files.append(ImportFile.objects.create(
+                dropbox_id='id:{}'.format(i), path_lower='/{}.csv'.format(i),
+                filename='{}.csv'.format(i), company=company,
+                export_type=export_type,
+                server_modified=now - timedelta(days=days)))
+            job = ImportJob.objects.create(import_file=files[-1])
+            DBLogEntry.objects.create(import_job=job, message='test')
+        # The newest file is kept even when it is expired.
+        other = ImportFile.objects.create(
+            dropbox_id='id:other', path_lower='/other.csv',
+            filename='other.csv', company=company,
+            export_type=ExportType.objects.create(name='Product'),
+            server_modified=now - timedelta(days=30))
+
+        # Dropbox fails to delete the second file.
+        with mock.patch.object(dropbox_interface, 'delete_files',
+                               side_effect=lambda paths: paths[::2]) as delete:
+            numb_deleted = self.controller.delete_expired_files(
+                retention_days=14)
+
+        self.assertEqual(sorted(delete.call_args[0][0]),
+                         ['/0.csv', '/1.csv', '/2.csv'])
+        self.assertEqual(numb_deleted, 2)
+        remaining = set(ImportFile.objects.values_list('id', flat=True))
+        self.assertEqual(len(remaining), 3)
+        self.assertIn(files[3].id, remaining)
+        self.assertIn(other.id, remaining)
+        self.assertEqual(ImportJob.objects.count(), 2)
+        self.assertEqual(DBLogEntry.objects.count(), 2)
+
+
+class ExportTaskTest(TestCase):
+
+    def setUp(self):
+        company = Company.objects.create(name='TestingCompany')
+        FulfillmentService.objects.create(
+            company=company, service_id=10, location_id=20,
+            is_import_destination=True)
+        self.export_type = ExportType.objects.create(name='Inventory')
+        self.file = self.create_file('id:new', timezone.now())
+        self.job = ImportJob.objects.create(import_file=self.file)
+
+    def tearDown(self):
+        Inventory('TestingCompany').reset()
+
+    def create_file(self, dropbox_id, server_modified):
+        return ImportFile.objects.create(
+            dropbox_id=dropbox_id, path_lower='/' + dropbox_id,
+            filename=dropbox_id, export_type=self.export_type,
+            company=Company.objects.get(name='TestingCompany'),
+            server_modified=server_modified, content_hash='a' * 64)
+
+    def test_skip_exported_content(self):
+        last_file = self.create_file(
+            'id:old', timezone.now() - timedelta(days=1))
+        ImportJob.objects.create(import_file=last_file,
+                                 status=ImportJob.SUCCESS,
+                                 end_time=timezone.now())
+
+        with mock.patch('core.tasks.ShopifyInterface') as shop:
+            self.assertTrue(export_to_shopify(self.job.pk))
+        self.assertFalse(shop.called)
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.import_status, ImportFile.IMPORTED)
+
+    def export(self, export_data=None):
+        """Runs the task for the job with export_data as the side effect of
+        the Shopify export."""
+        data = b'UPC,QUANTITY\n638700000001,3\n'
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        with mock.patch('core.tasks.ShopifyInterface'), \
+                mock.patch('core.tasks.dropbox_interface') as dropbox, \
+                mock.patch('core.tasks.InventoryExporter') as exporter:
+            dropbox.download_to_cache.return_value = path
+            dropbox.download_chunks.return_value = [data]
+            exporter.return_value.export_data.side_effect = export_data
+            return export_to_shopify(self.job.pk)
+
+    def test_export_error(self):
+        # The error fails the job instead of counting as exported.
+        with self.assertRaises(RuntimeError):
+            self.export(RuntimeError)
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.import_status, ImportFile.NOT_IMPORTED)
+
+    def test_superseded_during_import(self):
+        inventory = Inventory('TestingCompany')
+        with mock.patch.object(ImportFile, 'is_superseded',
+                               side_effect=[False, True]):
+            self.assertTrue(self.export())
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, ImportJob.SUPERSEDED)
+
+        # The staged snapshot is reclaimed.
+        self.assertIsNone(inventory.get_current_version())
+        version = int(inventory.redis.client.get(
+            inventory.redis.format_key('version')))
+        inventory.reclaim_snapshots(grace_period=timedelta(0))
+        self.assertFalse(inventory.has_snapshot(version))
+
+    def test_export_lock_expired(self):
+        inventory = Inventory('TestingCompany')
+
+        def export_data():
+            inventory.redis.client.delete(
+                inventory.redis.format_key('export_lock'))
+
+        self.assertTrue(self.export(export_data))
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.import_status, ImportFile.IMPORTED)
+
+
+class ImportProductsTaskTest(TestCase):
+
+    def setUp(self):
+        self.file = ImportFile.objects.create(
+            dropbox_id='id:0', path_lower='/0.csv', filename='0.csv',
+            company=Company.objects.create(name='TestingCompany'),
+            export_type=ExportType.objects.create(name='Product'),
+            server_modified=timezone.now(), content_hash='a' * 64)
+        self.job = ImportJob.objects.create(import_file=self.file)
+        self.variants = ProductVariants('TestingCompany')
+
+    def tearDown(self):
+        self.variants.reset()
+
+    def import_products(self, job, data):
+        """Runs the task for job with data as the downloaded file."""
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        with mock.patch('core.tasks.dropbox_interface') as dropbox:
+            dropbox.download_to_cache.return_value = path
+            self.assertTrue(import_products(job.pk))
+        return dropbox.download_to_cache.called
+
+    def test_import_products(self):
+        data = (b'STYLE NUMBER,COLOR CODE,SIZE 1,UPC 1,SIZE 2,UPC 2,\r\n'
+                b'880001,NVY,0,638700000001,2,bogus,\r\n'
+                b'12,NVY,0,638700000002,,,\r\n')
+        self.import_products(self.job, data)
+
+        self.assertEqual(self.variants.get_item_values('COLOR CODE'),
+                         {'638700000001': 'NVY'})
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.import_status, ImportFile.IMPORTED)
+        # The invalid style number is logged.
+        self.assertEqual(DBLogEntry.objects.filter(
+            import_job=self.job, level=DBLogEntry.WARNING).count(), 1)
+
+    def test_skip_imported_content(self):
+        ImportJob.objects.filter(pk=self.job.pk).update(
+            status=ImportJob.SUCCESS, end_time=timezone.now())
+        job = ImportJob.objects.create(import_file=self.file)
+        self.variants.begin_snapshot()
+        self.variants.add_item('638700000001', {'SIZE': 0})
+        self.variants.publish_snapshot()
+
+        data = b'STYLE NUMBER,\r\n'
+        self.assertFalse(self.import_products(job, data))
+
+        # The variants are imported again once they have expired.
+        self.variants.reset()
+        self.assertTrue(self.import_products(job, data))
@@ -0,0 +1,159 @@
+"""Benchmarks for parsing the export files.
+
+Compares the compiled row decoders with the previous parsing, which built a
+csv.DictReader dict for each row and looked up each column's load function
+for every value, the row by row parsing of Inventory files with the
+columnar NumPy parsing, the parsing of a Product file on one core with
+the process pool, and the Product converters with and without memoization.
+Run with:
+
+$ python -m csv_parser.benchmarks
+"""
+import csv, os, random, tempfile, timeit
+
+from . import columnar
+from .models import CSVRows, iter_lines
+from .parallel import ParallelCSVRows
+from .schemas import Schema, schemas
+
+
+def make_inventory_csv(numb_rows):
+    lines = ['UPC,QUANTITY,DATE,']
+    for i in range(numb_rows):
+        lines.append('{},{},IMMEDIATE,'.format(
+            638700000000 + i, random.randint(0, 20)))
+    return '\r\n'.join(lines).encode('utf8')
+
+def make_product_csv(numb_rows):
+    header = [name for name in schemas['Product'].columns]
+    lines = [','.join(header) + ',']
+    for i in range(numb_rows):
+        # Each style has 4 colors, prices and dates vary between styles.
+        style = i // 4
+        price = 395 + style % 20 * 50
+        values = {
+            'SEASON': 'FALL 2018',
+            'STYLE NUMBER': str(880000 + style),
+            'NAME': 'Gown',
+            'COLOR': 'Navy/Gold',
+            'COLOR CODE': str(i % 4),
+            'DEPARTMENT': 'Couture',
+            'DIVISION': 'Theia',
+            'ADDITIONAL SEASONS': '',
+            'WHOLESALE USD': '{}.00'.format(price),
+            'RETAIL USD': '{}.00'.format(price * 2 + 95),
+            'CATEGORY': 'Evening',
+            'SUBCATEGORY': 'Long',
+            'AVAILABLE START': '{:02d}/01/2018'.format(style % 12 + 1),
+            'AVAILABLE END': '12/31/2019',
+            'DESCRIPTION': 'Beaded gown with a sweetheart neckline',
+            'ARCHIVED': 'N',
+            'BRAND ID': 'THEIA',
+            'WHOLESALE CAD': '{}.00'.format(price + 150),
+            'RETAIL CAD': '{}.00'.format(price * 2 + 345),}
+        for n in range(1, 16):
+            values['SIZE {}'.format(n)] = str(n * 2 - 2)
+            values['UPC {}'.format(n)] = str(638700000000 + i * 15 + n)
+        lines.append(','.join(values.get(h, '') for h in header) + ',')
+    return '\r\n'.join(lines).encode('utf8')
+
+
+def parse_dict_rows(data, schema_name):
+    """The previous CSVRows parsing, kept here for comparison."""
+    schema = schemas[schema_name]
+    reader = csv.DictReader(iter_lines([data]))
+    columns = {h: schema.columns[h] for h in reader.fieldnames
+               if h in schema.columns}
+    rows = []
+    for raw_dict in reader:
+        processed = dict()
+        for k, v in raw_dict.items():
+            try:
+                processed[k] = columns[k].load(v)
+            except (IndexError, KeyError):
+                pass
+        rows.append(processed)
+    return rows
+
+def parse_compiled_rows(data, schema_name):
+    return list(CSVRows(data, schema_name))
+
+
+def parse_inventory_rows(data):
+    return [r for r in CSVRows(data, 'Inventory', columns=('UPC', 'QUANTITY'))
+            if r['UPC']]
+
+def parse_inventory_columns(data):
+    return columnar.InventoryColumns.from_bytes(data)
+
+
+def decode_rows(data, schema):
+    reader = csv.reader(iter_lines([data]))
+    decoder = schema.compile(next(reader))
+    return [decoder.decode(values) for values in reader if values]
+
+def unmemoized(schema):
+    """Returns a copy of schema without the load caches."""
+    return Schema(*((c.name, getattr(c.load, '__wrapped__', c.load), c.save)
+                    for c in schema.columns.values()))
+
+
+def bench(name, fn, repeat=3):
+    best = min(timeit.repeat(fn, number=1, repeat=repeat))
+    print('{:<40} {:>8.3f}s'.format(name, best))
+    return best
+
+
+def main():
+    random.seed(0)
+    files = [('Inventory', make_inventory_csv(100000)),
+             ('Product', make_product_csv(10000)),]
+    for schema_name, data in files:
+        assert (parse_dict_rows(data, schema_name)
+                == [dict(r) for r in parse_compiled_rows(data, schema_name)])
+        before = bench('{} DictReader'.format(schema_name),
+                       lambda: parse_dict_rows(data, schema_name))
+        after = bench('{} compiled decoder'.format(schema_name),
+                      lambda: parse_compiled_rows(data, schema_name))
+        print('{:<40} {:>8.2f}x'.format(
+            '{} speedup'.format(schema_name), before / after))
+
+    data = make_product_csv(20000)
+    schema = schemas['Product']
+    plain = unmemoized(schema)
+    assert decode_rows(data, plain) == decode_rows(data, schema)
+    before = bench('Product converters',
+                   lambda: decode_rows(data, plain))
+    schema.cache_clear()
+    after = bench('Product memoized converters',
+                  lambda: decode_rows(data, schema))
+    print('{:<40} {:>8.2f}x'.format('Product memoized speedup', before / after))
+    for name, info in sorted(schema.cache_info().items())[:3]:
+        print('{:<40} {}'.format(name, info))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'products.csv')
+        with open(path, 'wb') as f:
+            f.write(make_product_csv(40000))
+        before = bench('Product 40000 rows one core',
+                       lambda: list(CSVRows.from_file(path, 'Product')), 1)
+        after = bench('Product 40000 rows {} processes'.format(os.cpu_count()),
+                      lambda: list(ParallelCSVRows(path, 'Product')), 1)
+        print('{:<40} {:>8.2f}x'.format(
+            'Product 40000 rows speedup', before / after))
+
+    for numb_rows in (10000, 100000, 1000000):
+        data = make_inventory_csv(numb_rows)
+        assert (parse_inventory_rows(data)
+                == list(parse_inventory_columns(data)))
+        repeat = 1 if numb_rows >= 1000000 else 3
+        before = bench('Inventory {} rows by row'.format(numb_rows),
+                       lambda: parse_inventory_rows(data), repeat)
+        after = bench('Inventory {} rows columnar'.format(numb_rows),
+                      lambda: parse_inventory_columns(data), repeat)
+        print('{:<40} {:>8.2f}x'.format(
+            'Inventory {} rows speedup'.format(numb_rows), before / after))
+
+
+if __name__ == '__main__':
+    main()
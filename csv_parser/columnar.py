@@ -0,0 +1,257 @@
+"""Columnar parsing of Inventory files with NumPy.
+
+The rows are the same as the ones CSVRows parses with the Inventory schema,
+including the row errors.
+"""
+import logging, mmap, os
+
+import numpy as np
+
+from .helpers import DefaultValue
+from .models import CSVRows, RowErrors
+from .schemas import schemas
+
+
+log = logging.getLogger('development')
+
+COMMA, NEWLINE, CR = (ord(c) for c in ',\n\r')
+ZERO = ord('0')
+# Longest number that fits in an int64.
+MAX_DIGITS = 18
+# Range of the 12 digit UPCs accepted by valid_upc_from_str.
+MIN_UPC = 10 ** 11
+MAX_UPC = 10 ** 12
+
+
+class InventoryColumns:
+    """The UPC and QUANTITY columns of an Inventory file as int64 arrays.
+
+    upc_valid is the mask of the rows with a valid UPC, the UPCs of the other
+    rows are 0. Invalid quantities are 0, like quantity_from_str. The rows
+    without a valid UPC and the invalid quantities are recorded in errors. Iterating yields a row dict for each row with a valid UPC, so the
+    columns can be passed to an importer in place of CSVRows.
+    """
+
+    columns = ('UPC', 'QUANTITY')
+
+    def __init__(self, upcs, quantities, upc_valid, errors=None):
+        self.upcs = upcs
+        self.quantities = quantities
+        self.upc_valid = upc_valid
+        self.errors = errors or RowErrors()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Parses the contents of an Inventory file.
+
+        The rows are split and the values that are only digits converted
+        with array operations over the raw bytes. The other values, like
+        signed or padded numbers, are loaded one at a time with the load
+        functions of the Inventory schema. Files with quoted values are parsed
+        with CSVRows.
+        """
+        if not len(data):
+            return cls.from_rows([])
+        if data.find(b'"') != -1:
+            rows = CSVRows(bytes(data), 'Inventory', columns=cls.columns)
+            columns = cls.from_rows(rows)
+            columns.errors = rows.errors
+            return columns
+
+        header_end = data.find(b'\n')
+        if header_end == -1:
+            header_end = len(data)
+        header = bytes(data[:header_end]).decode('utf8').rstrip('\r,')
+        header = header.split(',')
+        try:
+            upc_index = header.index('UPC')
+            quantity_index = header.index('QUANTITY')
+        except ValueError:
+            raise ValueError(
+                'Inventory file is missing the UPC or QUANTITY column.')
+
+        body = np.frombuffer(data, dtype=np.uint8)[header_end + 1:]
+        return cls(*_parse_columns(body, upc_index, quantity_index))
+
+    @classmethod
+    def from_file(cls, path):
+        """Parses a local Inventory file through a memory map."""
+        # Empty files can't be mapped.
+        if os.path.getsize(path) == 0:
+            return cls.from_bytes(b'')
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return cls.from_bytes(mm)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Builds the columns from the rows of CSVRows, which only has the rows
+        with a valid UPC."""
+        upcs, quantities = [], []
+        for row in rows:
+            upcs.append(row.get('UPC') or 0)
+            quantities.append(row.get('QUANTITY') or 0)
+        upcs = np.array(upcs, dtype=np.int64)
+        return cls(upcs, np.array(quantities, dtype=np.int64), upcs != 0)
+
+    def __len__(self):
+        return len(self.upcs)
+
+    def __iter__(self):
+        upcs = self.upcs[self.upc_valid].tolist()
+        quantities = self.quantities[self.upc_valid].tolist()
+        for upc, quantity in zip(upcs, quantities):
+            yield {'UPC': upc, 'QUANTITY': quantity}
+
+
+def _parse_columns(body, upc_index, quantity_index):
+    """Returns the (upcs, quantities, upc_valid, errors) for the rows in body.
+    """
+    # Drop the carriage returns and end the last line.
+    body = body[body != CR]
+    if len(body) and body[-1] != NEWLINE:
+        body = np.append(body, np.uint8(NEWLINE))
+    if not len(body):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=bool), RowErrors()
+
+    newline = body == NEWLINE
+    # Every value ends at a separator.
+    ends = np.flatnonzero(newline | (body == COMMA))
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    ends_line = newline[ends]
+
+    # Line and column of each value.
+    line = np.empty(len(ends), dtype=np.int64)
+    line[0] = 0
+    np.cumsum(ends_line[:-1], out=line[1:])
+    line_starts = np.flatnonzero(np.concatenate(([True], ends_line[:-1])))
+    column = np.arange(len(ends)) - line_starts[line]
+
+    # Blank lines have a single empty value.
+    numb_values = np.diff(np.append(line_starts, len(ends)))
+    row_lines = np.flatnonzero(
+        (numb_values > 1) | (ends[line_starts] > starts[line_starts]))
+    row_of_line = np.full(len(line_starts), -1, dtype=np.int64)
+    row_of_line[row_lines] = np.arange(len(row_lines))
+    row = row_of_line[line]
+
+    numb_rows = len(row_lines)
+    upcs = np.zeros(numb_rows, dtype=np.int64)
+    quantities = np.zeros(numb_rows, dtype=np.int64)
+
+    columns = schemas['Inventory'].columns
+    selected = np.flatnonzero((column == upc_index) & (row >= 0))
+    numbers, digits = _parse_digits(body, starts[selected], ends[selected])
+    # Only the UPCs in the range of 12 digit numbers are valid.
+    numbers[digits & ((numbers < MIN_UPC) | (numbers >= MAX_UPC))] = 0
+    _load_values(body, starts[selected], ends[selected], ~digits, numbers,
+                 columns['UPC'].load)
+    upcs[row[selected]] = numbers
+    # Index of the UPC value of each row, -1 for short rows without one.
+    upc_values = np.full(numb_rows, -1, dtype=np.int64)
+    upc_values[row[selected]] = selected
+
+    selected = np.flatnonzero((column == quantity_index) & (row >= 0))
+    numbers, digits = _parse_digits(body, starts[selected], ends[selected])
+    invalid = _load_values(body, starts[selected], ends[selected], ~digits,
+                           numbers, columns['QUANTITY'].load)
+    quantities[row[selected]] = numbers
+
+    upc_valid = upcs != 0
+    # Rows without a valid UPC are skipped, the invalid quantities of the
+    # other rows are 0.
+    invalid_upc_rows = np.flatnonzero(~upc_valid)
+    invalid_quantities = selected[invalid & upc_valid[row[selected]]]
+    errors = _collect_errors(body, starts, ends, [
+        ('UPC', row_lines[invalid_upc_rows], upc_values[invalid_upc_rows],
+         'Invalid UPC, the row is skipped'),
+        ('QUANTITY', row_lines[row[invalid_quantities]], invalid_quantities,
+         'Invalid quantity, set to 0'),])
+
+    return upcs, quantities, upc_valid, errors
+
+def _collect_errors(body, starts, ends, invalid):
+    """Returns the RowErrors for the invalid values.
+
+    invalid is a list of (column, body line indexes, value indexes, reason)
+    with a value index of -1 for a missing value. Only the raw values of the
+    first errors in the file are decoded for the samples.
+    """
+    errors = RowErrors()
+    samples = []
+    for column, lines, values, reason in invalid:
+        errors.count += len(lines)
+        if len(lines):
+            errors.counts_by_column[column] += len(lines)
+        for line, value in zip(lines[:errors.max_samples].tolist(),
+                               values[:errors.max_samples].tolist()):
+            samples.append((line, column, value, reason))
+
+    for line, column, value, reason in sorted(
+            samples, key=lambda s: s[0])[:errors.max_samples]:
+        if value < 0:
+            raw = ''
+        else:
+            raw = body[starts[value]:ends[value]].tobytes().decode(
+                'utf8', 'replace')
+        # The line numbers count the header as line 1.
+        errors.samples.append((line + 2, column, raw, reason))
+    return errors
+
+def _parse_digits(body, starts, ends):
+    """Converts the values between starts and ends that are only digits to
+    integers.
+
+    Returns the (numbers, digits) arrays, where digits is the mask of the
+    values that were converted. The numbers of the other values are 0. The
+    digits of every value are converted together, from the last digit to the
+    first.
+    """
+    numb_digits = ends - starts
+    digits = (numb_digits > 0) & (numb_digits <= MAX_DIGITS)
+
+    numbers = np.zeros(len(starts), dtype=np.int64)
+    for k in range(MAX_DIGITS):
+        indexes = np.flatnonzero(digits & (numb_digits > k))
+        if not len(indexes):
+            break
+        values = body[ends[indexes] - 1 - k].astype(np.int64) - ZERO
+        is_digit = (values >= 0) & (values <= 9)
+        digits[indexes[~is_digit]] = False
+        numbers[indexes] += np.where(is_digit, values, 0) * 10 ** k
+
+    numbers[~digits] = 0
+    return numbers, digits
+
+def _load_values(body, starts, ends, selected, numbers, load):
+    """Loads the values selected by the mask with a load function of the
+    Inventory schema into numbers.
+
+    The blank values are loaded once for all of them. Values that can't be
+    loaded are 0, or the default of a DefaultValue. Returns the mask of the
+    invalid values.
+    """
+    invalid = np.zeros(len(starts), dtype=bool)
+    blank = selected & (ends == starts)
+    if blank.any():
+        try:
+            numbers[blank] = load('')
+        except DefaultValue as e:
+            numbers[blank] = e.default
+            invalid[blank] = True
+        except ValueError:
+            invalid[blank] = True
+
+    for k in np.flatnonzero(selected & ~blank).tolist():
+        value = body[starts[k]:ends[k]].tobytes().decode('utf8', 'replace')
+        try:
+            numbers[k] = load(value)
+        except DefaultValue as e:
+            numbers[k] = e.default
+            invalid[k] = True
+        except ValueError:
+            invalid[k] = True
+    return invalid
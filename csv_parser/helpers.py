@@ -8,6 +8,19 @@ log = logging.getLogger('django')
 
 NON_NUMERIC = re.compile(r'[^\d]+')
 SIX_DIGITS = re.compile(r'^\d{6}$')
+# Quantities are stored as int64.
+MIN_QUANTITY = -2 ** 63
+MAX_QUANTITY = 2 ** 63 - 1
+
+
+class DefaultValue(ValueError):
+    """Raised by a load function for an invalid value that is replaced by
+    default instead of skipping the row."""
+
+    def __init__(self, message, default):
+        super().__init__(message)
+        self.default = default
+
 
 def parse_style_number(s):
     """Strip alpha chars and ensure style number is 6 digits long"""
@@ -38,6 +51,22 @@ def valid_upc_or_none_from_str(upc):
     else:
         return None
 
+def valid_upc_from_str(upc):
+    """return a valid upc from passed string or raise ValueError"""
+    upc = valid_upc_or_none_from_str(upc)
+    if upc is None:
+        raise ValueError('Invalid UPC, the row is skipped')
+    return upc
+
+def quantity_from_str(x):
+    """return the quantity in passed string, 0 for a blank string"""
+    if x == '':
+        return 0
+    quantity = int_or_none(x)
+    if quantity is None or not MIN_QUANTITY <= quantity <= MAX_QUANTITY:
+        raise DefaultValue('Invalid quantity, set to 0', 0)
+    return quantity
+
 def date_or_none_from_string(date_string):
     date_format = '%m/%d/%Y'
 
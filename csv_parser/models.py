@@ -1,54 +1,252 @@
-import csv, logging
+import csv, logging, mmap, os
+from collections import Counter, namedtuple
 
 from .schemas import schemas
 
 
 log = logging.getLogger('development')
 
+# Size of the chunks read from a streaming download response.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Product files have a SIZE n and UPC n column for each of these.
+SIZE_UPC_RANGE = range(1, 16)
+
+
+def iter_lines(chunks):
+    """Yields decoded lines from an iterable of byte chunks.
+
+    Lines are split on the raw bytes so a multi-byte utf8 character that
+    straddles two chunks is only decoded once its line is complete. Only the
+    current partial line is held in memory.
+    """
+    pending = b''
+    for chunk in chunks:
+        if not chunk:
+            continue
+        pending += chunk
+        lines = pending.splitlines(keepends=True)
+        # The last line may continue in the next chunk. A trailing '\r' is held
+        # back as well in case the '\n' of a '\r\n' is in the next chunk.
+        if lines and not lines[-1].endswith(b'\n'):
+            pending = lines.pop()
+        else:
+            pending = b''
+        for l in lines:
+            yield _clean_line(l)
+
+    if pending:
+        yield _clean_line(pending)
+
+def _clean_line(line):
+    # trim the trailing comma, the export files all seem to have it. By
+    # removing it here we avoid creating an empty column on the right side
+    # of the CSV.
+    return line.rstrip(b'\r\n').decode('utf8').rstrip(',')
+
+
+class RowErrors:
+    """Collects the rows of a file that couldn't be loaded.
+
+    Every error is counted by column, but only the first max_samples are kept
+    as (line number, column, raw value, reason) so a bad file doesn't use
+    more memory as it grows.
+    """
+
+    max_samples = 10
+
+    def __init__(self, max_samples=None):
+        if max_samples is not None:
+            self.max_samples = max_samples
+        self.count = 0
+        self.counts_by_column = Counter()
+        self.samples = []
+
+    def add(self, line_number, column, value, reason):
+        self.count += 1
+        self.counts_by_column[column] += 1
+        if len(self.samples) < self.max_samples:
+            self.samples.append((line_number, column, value, reason))
+
+    def merge(self, other, line_offset=0):
+        """Adds the errors of another part of the same file, whose line
+        numbers start after line_offset."""
+        self.count += other.count
+        self.counts_by_column.update(other.counts_by_column)
+        for line_number, column, value, reason in other.samples:
+            if len(self.samples) >= self.max_samples:
+                break
+            self.samples.append(
+                (line_number + line_offset, column, value, reason))
+
+    def __len__(self):
+        return self.count
+
+    def summary(self):
+        """Returns a message describing the errors for the import job log."""
+        lines = ['{} rows with invalid data ({}).'.format(
+            self.count, ', '.join(
+                '{}: {}'.format(c, n)
+                for c, n in self.counts_by_column.most_common()))]
+        for line_number, column, value, reason in self.samples:
+            lines.append('Line {}, {} "{}": {}'.format(
+                line_number, column, value, reason))
+        return '\n'.join(lines)
+
 
 class CSVRows:
-    """Provides an itererator interface for the ImportFile csv data"""
+    """Provides an itererator interface for the ImportFile csv data
+
+    text is either the full contents of the file as bytes or an iterable of
+    byte chunks, like a streaming download, which is parsed as it arrives.
+    Each row is a Row mapping of the loaded values by column name, decoded
+    by a RowDecoder compiled from the file's header. columns is the list of
+    the columns the consumer needs, the other columns are not loaded. Rows
+    with a value that can't be loaded are skipped, the invalid values are
+    collected in errors.
+    """
 
-    def __init__(self, text, schema_name):
+    def __init__(self, text, schema_name, columns=None):
         self.schema = schemas[schema_name]
 
-        lines = text.splitlines()
-        # trim the trailing comma, the export files all seem to have it. By
-        # removing it here we avoid creating an empty column on the right side
-        # of the CSV.
-        lines = [l.decode('utf8').rstrip(',') for l in lines]
-        self.numb_lines_total = len(lines)
-        self._csv_reader = csv.DictReader(lines)
+        if isinstance(text, (bytes, bytearray)):
+            text = (text,)
+        # Number of lines read so far, including the header. This is the total
+        # number of lines in the file once the rows have been consumed.
+        self.numb_lines_total = 0
+        self.errors = RowErrors()
+        self._csv_reader = csv.reader(self._count_lines(iter_lines(text)))
+        # The decoder for this file's columns is compiled from the header.
+        self.decoder = self.schema.compile(
+            next(self._csv_reader, ()), columns)
         # map each column's schema for each column that is in the data
-        self.columns = dict()
-        for h in self._csv_reader.fieldnames:
-            try:
-                self.columns[h] = self.schema.columns[h]
-            except KeyError:
-                pass
+        self.columns = {
+            f: self.schema.columns[f] for f in self.decoder.fields}
+
+    @classmethod
+    def from_response(cls, response, schema_name, columns=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE):
+        """Parses the rows from a download response as the body is streamed.
+        """
+        return cls(_iter_response(response, chunk_size), schema_name,
+                   columns)
+
+    @classmethod
+    def from_file(cls, path, schema_name, columns=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+        """Parses the rows of a local file through a memory map."""
+        return cls(_iter_file(path, chunk_size), schema_name, columns)
+
+    def _count_lines(self, lines):
+        for l in lines:
+            self.numb_lines_total += 1
+            yield l
 
     def __iter__(self):
         return self
 
-    # TODO: Gather the specific errors here and the row and column info for
-    # errors. Log these to the import job somehow.
-    # I think I need to add an is_valid function to the schema so that I can
-    # test the values before I load them. The load function does it's best
-    # to return a usable value.
-    # Also if load is not able to return a usable value, like with invalid
-    # UPCs, we should skip that line, record the line number, and try to
-    # process the next line.
+    # Load functions that return a usable value for bad data, like None for
+    # invalid Product UPCs, don't count as errors.
     def __next__(self):
-        raw_dict = next(self._csv_reader)
-        processed = dict()
-        for k,v in raw_dict.items():
+        while True:
+            values = next(self._csv_reader)
+            # Skip blank lines
+            if not values:
+                continue
             try:
-                processed[k] = self.columns[k].load(v)
-            except IndexError:
-                pass
-            except ValueError as e:
-                log.exception(e)
-                log.warning('Row contains invalid data')
-                log.warning(raw_dict)
-                return None
-        return processed
+                return self.decoder.decode(values)
+            except ValueError:
+                # The row is decoded again only to find the invalid values.
+                row, errors = self.decoder.find_errors(values)
+                for column, value, reason in errors:
+                    self.errors.add(self._csv_reader.line_num, column, value,
+                                    reason)
+                if row is not None:
+                    return row
+
+
+VariantRecord = namedtuple('VariantRecord',
+                           ['style_number', 'color_code', 'size', 'upc'])
+
+
+class ProductVariantRows:
+    """Iterates the variants of a Product file as VariantRecords.
+
+    Each row of a Product file is a style and color with up to 15 SIZE n and
+    UPC n column pairs. Only the columns needed for the variants are loaded
+    and their positions are resolved once from the header. Pairs without a
+    size or a valid UPC are skipped.
+
+    rows are the CSVRows or ParallelCSVRows of the file parsed with columns.
+    """
+
+    columns = (('STYLE NUMBER', 'COLOR CODE')
+               + tuple('SIZE {}'.format(n) for n in SIZE_UPC_RANGE)
+               + tuple('UPC {}'.format(n) for n in SIZE_UPC_RANGE))
+
+    def __init__(self, rows):
+        self.rows = rows
+        index = self.rows.decoder.index
+        self._style_index = index.get('STYLE NUMBER')
+        self._color_code_index = index.get('COLOR CODE')
+        self._size_upc_indexes = [
+            (index['SIZE {}'.format(n)], index['UPC {}'.format(n)])
+            for n in SIZE_UPC_RANGE
+            if 'SIZE {}'.format(n) in index and 'UPC {}'.format(n) in index]
+
+    @classmethod
+    def from_text(cls, text):
+        """Parses the variants from the text of a file or chunks of it."""
+        return cls(CSVRows(text, 'Product', columns=cls.columns))
+
+    @classmethod
+    def from_response(cls, response, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Parses the variants from a download response as the body is
+        streamed."""
+        return cls.from_text(_iter_response(response, chunk_size))
+
+    @classmethod
+    def from_file(cls, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Parses the variants of a local file through a memory map."""
+        return cls.from_text(_iter_file(path, chunk_size))
+
+    @property
+    def errors(self):
+        return self.rows.errors
+
+    def __iter__(self):
+        style_index = self._style_index
+        color_code_index = self._color_code_index
+        size_upc_indexes = self._size_upc_indexes
+        values_of = self.rows.decoder.values
+        for row in self.rows:
+            values = values_of(row)
+            style_number = (None if style_index is None
+                            else values[style_index])
+            color_code = (None if color_code_index is None
+                          else values[color_code_index])
+            for size_index, upc_index in size_upc_indexes:
+                size = values[size_index]
+                upc = values[upc_index]
+                if size is None or upc is None:
+                    continue
+                yield VariantRecord(style_number, color_code, size, upc)
+
+
+def _iter_response(response, chunk_size):
+    """Yields the body of a requests response in chunks then closes it."""
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        response.close()
+
+def _iter_file(path, chunk_size):
+    """Yields the contents of a file in chunks from a read only memory map."""
+    # Empty files can't be mapped.
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start in range(0, len(mm), chunk_size):
+            yield mm[start:start + chunk_size]
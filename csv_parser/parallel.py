@@ -0,0 +1,94 @@
+import logging, mmap, os
+
+from billiard import Pool
+
+from .models import CSVRows, RowErrors
+
+
+log = logging.getLogger('development')
+
+# Size of the parts of a file parsed by each task in the pool.
+DEFAULT_PART_SIZE = 1024 * 1024
+
+
+class ParallelCSVRows:
+    """Parses a local CSV file on several cores.
+
+    The file is split on line boundaries into parts of about part_size bytes
+    that are parsed with CSVRows in a pool of worker processes. The rows are
+    yielded in the same order as the file and the row errors of the parts are
+    merged, with their line numbers in the whole file.
+
+    The pool is a billiard pool, the multiprocessing fork used by celery,
+    which can be started from the daemonic celery prefork workers.
+    """
+
+    def __init__(self, path, schema_name, columns=None, workers=None,
+                 part_size=DEFAULT_PART_SIZE):
+        self.path = path
+        self.schema_name = schema_name
+        self.columns = columns
+        self.workers = workers or os.cpu_count() or 1
+        self.part_size = part_size
+        self.errors = RowErrors()
+
+        self._header, self._parts = _split_file(path, part_size)
+        # Rows are sent back from the workers as tuples of values and made
+        # into rows with this decoder's row class.
+        self.decoder = CSVRows(self._header, schema_name, columns).decoder
+        # Number of lines read so far, including the header.
+        self.numb_lines_total = 1 if self._header else 0
+
+    def __iter__(self):
+        row_class = self.decoder.row_class
+        for values, errors, numb_lines in self._parse_parts():
+            self.errors.merge(errors, line_offset=self.numb_lines_total - 1)
+            self.numb_lines_total += numb_lines
+            for v in values:
+                yield row_class(v)
+
+    def _parse_parts(self):
+        args = [(self.path, self.schema_name, self.columns, self._header,
+                 start, end) for start, end in self._parts]
+        if self.workers < 2 or len(args) < 2:
+            for a in args:
+                yield _parse_part(*a)
+            return
+
+        with Pool(processes=min(self.workers, len(args))) as pool:
+            # imap() returns the results in the order of the parts.
+            for result in pool.imap(_parse_part_args, args):
+                yield result
+
+
+def _split_file(path, part_size):
+    """Returns the header line and the (start, end) byte offsets of the parts
+    of the file after it, each ending at the end of a line."""
+    if os.path.getsize(path) == 0:
+        return b'', []
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_end = mm.find(b'\n') + 1 or len(mm)
+        parts = []
+        start = header_end
+        while start < len(mm):
+            end = mm.find(b'\n', start + part_size) + 1 or len(mm)
+            parts.append((start, end))
+            start = end
+        return mm[:header_end], parts
+
+def _parse_part_args(args):
+    return _parse_part(*args)
+
+def _parse_part(path, schema_name, columns, header, start, end):
+    """Parses one part of a file in a worker process.
+
+    Returns the values of each row, the RowErrors with line numbers counted
+    from the start of the part, and the number of lines in the part.
+    """
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+    rows = CSVRows((header, data), schema_name, columns)
+    values = [rows.decoder.values(r) for r in rows]
+    return values, rows.errors, rows.numb_lines_total - 1
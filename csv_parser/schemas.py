@@ -1,3 +1,6 @@
+from collections.abc import Mapping
+from functools import lru_cache
+
 from .helpers import *
 
 class Schema:
@@ -5,16 +8,154 @@ class Schema:
     Encapsulates the logic for reading and writing each CSV format.
     describes how each of the columns in the rows of a CSV file map
     to Products and vice versa.
+
+    The load functions of the columns in memoize cache their results by raw
+    value, for columns where the same values repeat on many rows.
     """
 
-    def __init__(self, *columns):
+    def __init__(self, *columns, memoize=()):
         self.columns = dict()
 
         for key, load_fn, save_fn in columns:
-            self.columns[key] = Column(key, load_fn, save_fn)
+            self.columns[key] = Column(key, load_fn, save_fn,
+                                       memoize=key in memoize)
+
+    def cache_info(self):
+        """Returns the load cache statistics of the memoized columns by name.
+        """
+        return {name: c.load.cache_info() for name, c in self.columns.items()
+                if c.memoized}
+
+    def cache_clear(self):
+        for c in self.columns.values():
+            if c.memoized:
+                c.load.cache_clear()
+
+    def compile(self, header, columns=None):
+        """Returns a RowDecoder for the rows of a file with this header.
+
+        With columns, only those columns are decoded.
+        """
+        return RowDecoder(self, header, columns)
+
+
+class Row(Mapping):
+    """Read only mapping of a decoded row's values by column name.
+
+    The values are stored in a tuple and the column positions are shared by
+    every row of the same file, so a row costs about as much as a tuple.
+    """
+
+    __slots__ = ('_values',)
+
+    # Set on the Row class that RowDecoder creates for each file.
+    _fields = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return 'Row({})'.format(dict(self))
+
+
+class RowDecoder:
+    """Converts the raw csv.reader rows of a file to Row objects.
+
+    The position and load function of each schema column in the header are
+    resolved once. Columns that aren't in the schema, or not in columns when
+    it is given, are skipped without being read. Columns that aren't in the
+    header are left out of the rows.
+
+    A value that can't be loaded skips its row, unless its load function
+    raises DefaultValue, then the default is loaded in its place.
+
+    fields are the names of the loaded columns and index maps each one to
+    its position in the tuple returned by values(), for consumers that read
+    many rows by position instead of by name.
+    """
+
+    def __init__(self, schema, header, columns=None):
+        if columns is not None:
+            unknown = set(columns) - set(schema.columns)
+            if unknown:
+                raise ValueError('Columns not in the schema: {}'.format(
+                    ', '.join(sorted(unknown))))
+            columns = set(columns)
+
+        fields = []
+        indexes = []
+        loaders = []
+        for i, name in enumerate(header):
+            column = schema.columns.get(name)
+            if column is None or name in fields:
+                continue
+            if columns is not None and name not in columns:
+                continue
+            fields.append(name)
+            indexes.append(i)
+            loaders.append(column.load)
+
+        self.fields = tuple(fields)
+        self.index = {f: i for i, f in enumerate(self.fields)}
+        self.row_class = type('Row', (Row,), {
+            '__slots__': (),
+            '_fields': self.fields,
+            '_index': self.index})
+        self._columns = tuple(zip(indexes, loaders))
+        self._width = max(indexes) + 1 if indexes else 0
+
+    def decode(self, values):
+        """Returns the Row for a list of raw values.
+
+        Missing values at the end of a short row are read as ''. Raises
+        ValueError if a value can't be loaded.
+        """
+        if len(values) < self._width:
+            values = values + [''] * (self._width - len(values))
+        return self.row_class(
+            tuple([load(values[i]) for i, load in self._columns]))
+
+    def values(self, row):
+        """Returns the tuple of a row's loaded values in the order of fields.
+        """
+        return row._values
+
+    def find_errors(self, values):
+        """Decodes a row that decode() raised ValueError for.
+
+        Returns the (row, errors) for the row, with the (column, raw value,
+        reason) of each invalid value in errors. When a value can't be loaded
+        the row is None and errors only has that value, otherwise the
+        defaults of the invalid values are in the row.
+        """
+        loaded = []
+        errors = []
+        for name, (i, load) in zip(self.fields, self._columns):
+            value = values[i] if i < len(values) else ''
+            try:
+                loaded.append(load(value))
+            except DefaultValue as e:
+                loaded.append(e.default)
+                errors.append((name, value, str(e)))
+            except ValueError as e:
+                return None, [(name, value, str(e))]
+        return self.row_class(tuple(loaded)), errors
 
 class Column:
-    def __init__(self, name, load_fn, save_fn):
+    # Most values cached for each memoized column.
+    cache_size = 1024
+
+    def __init__(self, name, load_fn, save_fn, memoize=False):
         self.name = name
 
         if callable(load_fn):
@@ -22,6 +163,11 @@ class Column:
         else:
             self.load = lambda x: x
 
+        # Values that fail to load raise each time, they aren't cached.
+        self.memoized = memoize
+        if memoize:
+            self.load = lru_cache(maxsize=self.cache_size)(self.load)
+
         if callable(save_fn):
             self.save = save_fn
         else:
@@ -29,8 +175,8 @@ class Column:
 
 schemas = {
     'Inventory': Schema(
-        ('UPC', valid_upc_or_none_from_str, valid_upc_or_none_from_str),
-        ('QUANTITY', int_or_zero, int_or_zero),
+        ('UPC', valid_upc_from_str, valid_upc_or_none_from_str),
+        ('QUANTITY', quantity_from_str, int_or_zero),
         ('DATE', str, str),
     ),
     'Product': Schema(
@@ -83,5 +229,11 @@ schemas = {
         ('UPC 14', valid_upc_or_none_from_str, valid_upc_or_none_from_str),
         ('SIZE 15', int_or_none, int_or_none),
         ('UPC 15', valid_upc_or_none_from_str, valid_upc_or_none_from_str),
+        # The UPCs are unique, the other converted values repeat for every
+        # color and size of a style and across styles.
+        memoize=(
+            ['STYLE NUMBER', 'WHOLESALE USD', 'RETAIL USD', 'AVAILABLE START',
+             'AVAILABLE END', 'ARCHIVED', 'WHOLESALE CAD', 'RETAIL CAD']
+            + ['SIZE {}'.format(n) for n in range(1, 16)]),
     ),
 }
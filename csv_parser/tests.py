@@ -1,3 +1,304 @@
-from django.test import TestCase
+import os, tempfile
 
-# Create your tests here.
+import billiard
+from django.test import SimpleTestCase
+
+from . import columnar
+from .parallel import ParallelCSVRows
+from .models import CSVRows, ProductVariantRows, VariantRecord, iter_lines
+from .helpers import int_or_zero, parse_style_number
+from .schemas import Schema, schemas
+
+
+inventory_csv = (
+    'UPC,QUANTITY,DATE,\r\n'
+    '638700000001,3,IMMEDIATE,\r\n'
+    '638700000002,0,IMMEDIATE,\r\n'
+    'bogus,é,IMMEDIATE,').encode('utf8')
+
+
+def chunk(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+class IterLinesTest(SimpleTestCase):
+
+    def test_split_chunks(self):
+        expected = list(iter_lines([inventory_csv]))
+        self.assertEqual(expected[0], 'UPC,QUANTITY,DATE')
+        self.assertEqual(expected[-1], 'bogus,é,IMMEDIATE')
+        # Splitting inside a '\r\n' or a multi-byte character should not
+        # change the lines.
+        for size in (1, 2, 3, 5, 64):
+            self.assertEqual(
+                expected, list(iter_lines(chunk(inventory_csv, size))))
+
+
+class RowDecoderTest(SimpleTestCase):
+
+    def test_decode(self):
+        decoder = schemas['Inventory'].compile(
+            ['DATE', 'BOGUS', 'QUANTITY', 'UPC'])
+        # Columns that aren't in the schema are skipped.
+        self.assertEqual(decoder.fields, ('DATE', 'QUANTITY', 'UPC'))
+
+        row = decoder.decode(['IMMEDIATE', 'x', '3', '638700000001'])
+        self.assertEqual(row['UPC'], 638700000001)
+        self.assertEqual(list(row), ['DATE', 'QUANTITY', 'UPC'])
+        self.assertEqual(row, {
+            'UPC': 638700000001, 'QUANTITY': 3, 'DATE': 'IMMEDIATE'})
+        with self.assertRaises(KeyError):
+            row['BOGUS']
+        self.assertEqual(decoder.index, {'DATE': 0, 'QUANTITY': 1, 'UPC': 2})
+        self.assertEqual(decoder.values(row), ('IMMEDIATE', 3, 638700000001))
+
+        # Missing values at the end of the row are blank.
+        with self.assertRaises(ValueError):
+            decoder.decode(['IMMEDIATE'])
+        self.assertEqual(decoder.find_errors(['IMMEDIATE']), (None, [
+            ('UPC', '', 'Invalid UPC, the row is skipped')]))
+
+    def test_default_value(self):
+        decoder = schemas['Inventory'].compile(['QUANTITY', 'UPC'])
+        with self.assertRaises(ValueError):
+            decoder.decode(['x', '638700000001'])
+        row, errors = decoder.find_errors(['x', '638700000001'])
+        self.assertEqual(row, {'QUANTITY': 0, 'UPC': 638700000001})
+        self.assertEqual(errors, [
+            ('QUANTITY', 'x', 'Invalid quantity, set to 0')])
+        # Only the error of a skipped row is returned.
+        self.assertEqual(decoder.find_errors(['x', 'bogus']), (None, [
+            ('UPC', 'bogus', 'Invalid UPC, the row is skipped')]))
+
+    def test_invalid_value(self):
+        decoder = schemas['Product'].compile(['STYLE NUMBER', 'NAME'])
+        self.assertEqual(dict(decoder.decode(['ab880001', 'Gown'])),
+                         {'STYLE NUMBER': 880001, 'NAME': 'Gown'})
+        with self.assertRaises(ValueError):
+            decoder.decode(['123', 'Gown'])
+
+
+class SchemaTest(SimpleTestCase):
+
+    def test_memoize(self):
+        schema = Schema(('STYLE NUMBER', parse_style_number, None),
+                        ('QUANTITY', int_or_zero, None),
+                        memoize=['STYLE NUMBER'])
+        decoder = schema.compile(['STYLE NUMBER', 'QUANTITY'])
+        for values in (['880001', '1'], ['880001', '2'], ['880002', '1']):
+            decoder.decode(values)
+        with self.assertRaises(ValueError):
+            decoder.decode(['12', '1'])
+
+        self.assertEqual(list(schema.cache_info()), ['STYLE NUMBER'])
+        info = schema.cache_info()['STYLE NUMBER']
+        # Values that fail to load aren't cached.
+        self.assertEqual((info.hits, info.currsize), (1, 2))
+        schema.cache_clear()
+        self.assertEqual(schema.cache_info()['STYLE NUMBER'].currsize, 0)
+
+
+class CSVRowsTest(SimpleTestCase):
+
+    def test_rows(self):
+        rows = list(CSVRows(inventory_csv, 'Inventory'))
+        # The row without a valid UPC is skipped.
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0], {
+            'UPC': 638700000001, 'QUANTITY': 3, 'DATE': 'IMMEDIATE'})
+
+    def test_columns(self):
+        rows = list(CSVRows(inventory_csv, 'Inventory',
+                            columns=('UPC', 'QUANTITY')))
+        self.assertEqual(rows[0], {'UPC': 638700000001, 'QUANTITY': 3})
+        self.assertNotIn('DATE', rows[0])
+        with self.assertRaises(ValueError):
+            CSVRows(inventory_csv, 'Inventory', columns=('UPC', 'BOGUS'))
+
+    def test_errors(self):
+        data = ('STYLE NUMBER,NAME\r\n'
+                '880001,Gown\r\n'
+                '12,Dress\r\n'
+                '880002,Gown\r\n'
+                'bogus,Skirt\r\n').encode('utf8')
+        rows = CSVRows(data, 'Product')
+        rows.errors.max_samples = 1
+        # Rows with invalid values are skipped.
+        self.assertEqual([r['STYLE NUMBER'] for r in rows], [880001, 880002])
+        self.assertEqual(rows.errors.count, 2)
+        self.assertEqual(rows.errors.counts_by_column, {'STYLE NUMBER': 2})
+        self.assertEqual(rows.errors.samples, [
+            (3, 'STYLE NUMBER', '12',
+             'Style number (12) is not 6 digits long')])
+        self.assertEqual(rows.errors.summary().splitlines(), [
+            '2 rows with invalid data (STYLE NUMBER: 2).',
+            'Line 3, STYLE NUMBER "12": Style number (12) is not 6 digits '
+            'long'])
+
+        rows = CSVRows(inventory_csv, 'Inventory')
+        list(rows)
+        self.assertEqual(rows.errors.samples, [
+            (4, 'UPC', 'bogus', 'Invalid UPC, the row is skipped')])
+
+    def test_blank_lines(self):
+        data = inventory_csv.replace(b'\r\n', b'\r\n\r\n')
+        self.assertEqual(list(CSVRows(data, 'Inventory')),
+                         list(CSVRows(inventory_csv, 'Inventory')))
+
+    def test_streamed_rows(self):
+        rows = list(CSVRows(inventory_csv, 'Inventory'))
+        streamed = CSVRows(chunk(inventory_csv, 7), 'Inventory')
+        self.assertEqual(rows, list(streamed))
+        self.assertEqual(streamed.numb_lines_total, 4)
+
+    def test_file_rows(self):
+        rows = list(CSVRows(inventory_csv, 'Inventory'))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'inventory.csv')
+            with open(path, 'wb') as f:
+                f.write(inventory_csv)
+            self.assertEqual(
+                rows, list(CSVRows.from_file(path, 'Inventory', chunk_size=5)))
+
+            open(path, 'wb').close()
+            self.assertEqual(list(CSVRows.from_file(path, 'Inventory')), [])
+
+
+class ProductVariantRowsTest(SimpleTestCase):
+
+    def test_variants(self):
+        data = ('SEASON,STYLE NUMBER,COLOR CODE,SIZE 1,UPC 1,SIZE 2,UPC 2,'
+                'SIZE 3,UPC 3,\r\n'
+                'FALL 2018,880001,NVY,0,638700000001,2,638700000002,,,\r\n'
+                'FALL 2018,880001,GLD,0,638700000003,2,bogus,4,\r\n'
+                'FALL 2018,12,NVY,0,638700000004,,,,,\r\n').encode('utf8')
+        variants = ProductVariantRows.from_text(data)
+        self.assertEqual(list(variants), [
+            VariantRecord(880001, 'NVY', 0, 638700000001),
+            VariantRecord(880001, 'NVY', 2, 638700000002),
+            VariantRecord(880001, 'GLD', 0, 638700000003),])
+        self.assertEqual(variants.errors.count, 1)
+
+
+class ParallelCSVRowsTest(SimpleTestCase):
+
+    def test_rows(self):
+        lines = ['STYLE NUMBER,NAME,WHOLESALE USD,']
+        for i in range(200):
+            style = str(880000 + i) if i % 50 != 7 else 'bogus'
+            lines.append('{},Gown {},{}.50,'.format(style, i, i))
+            if i % 30 == 0:
+                lines.append('')
+        data = '\r\n'.join(lines).encode('utf8')
+        serial = CSVRows(data, 'Product')
+        expected = list(serial)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'products.csv')
+            with open(path, 'wb') as f:
+                f.write(data)
+            for workers in (1, 2):
+                rows = ParallelCSVRows(path, 'Product', workers=workers,
+                                       part_size=500)
+                self.assertEqual(list(rows), expected)
+                self.assertEqual(rows.numb_lines_total,
+                                 serial.numb_lines_total)
+                self.assertEqual(rows.errors.count, 4)
+                self.assertEqual(rows.errors.samples, serial.errors.samples)
+
+            # Celery prefork workers are daemonic billiard processes.
+            with billiard.Pool(processes=1) as pool:
+                daemon, rows = pool.apply(parse_in_worker, (path,))
+            self.assertTrue(daemon)
+            self.assertEqual(rows, [dict(r) for r in expected])
+
+            open(path, 'wb').close()
+            self.assertEqual(list(ParallelCSVRows(path, 'Product')), [])
+
+
+def parse_in_worker(path):
+    rows = ParallelCSVRows(path, 'Product', workers=2, part_size=500)
+    return (billiard.current_process().daemon,
+            [dict(r) for r in rows])
+
+
+class InventoryColumnsTest(SimpleTestCase):
+
+    def assert_same_rows(self, data):
+        rows = [dict(r) for r in CSVRows(data, 'Inventory',
+                                         columns=('UPC', 'QUANTITY'))
+                if r['UPC']]
+        self.assertEqual(list(columnar.InventoryColumns.from_bytes(data)),
+                         rows)
+
+    def test_columns(self):
+        columns = columnar.InventoryColumns.from_bytes(inventory_csv)
+        self.assertEqual(columns.upcs.tolist(),
+                         [638700000001, 638700000002, 0])
+        self.assertEqual(columns.quantities.tolist(), [3, 0, 0])
+        self.assertEqual(columns.upc_valid.tolist(), [True, True, False])
+        self.assert_same_rows(inventory_csv)
+
+    def test_invalid_values(self):
+        data = ('DATE,QUANTITY,UPC,\r\n'
+                'X,-2,638700000001,\r\n'
+                '\r\n'
+                'X,+4,0638700000002\r\n'
+                'X,5,123,\r\n'
+                'X,1x,638700000003,\r\n'
+                'X,,-638700000004,\r\n'
+                'X,7\r\n'
+                'X,8,6387000000059').encode('utf8')
+        self.assert_same_rows(data)
+        # Quoted values are parsed with CSVRows.
+        self.assert_same_rows(data.replace(b'X', b'"X, Y"'))
+
+        errors = columnar.InventoryColumns.from_bytes(data).errors
+        self.assertEqual(errors.count, 5)
+        self.assertEqual(errors.counts_by_column,
+                         {'UPC': 4, 'QUANTITY': 1})
+        self.assertEqual(errors.samples, [
+            (5, 'UPC', '123', 'Invalid UPC, the row is skipped'),
+            (6, 'QUANTITY', '1x', 'Invalid quantity, set to 0'),
+            (7, 'UPC', '-638700000004', 'Invalid UPC, the row is skipped'),
+            (8, 'UPC', '', 'Invalid UPC, the row is skipped'),
+            (9, 'UPC', '6387000000059', 'Invalid UPC, the row is skipped'),])
+
+    def test_same_as_rows(self):
+        # Values that aren't only digits are loaded like CSVRows loads them.
+        data = ('UPC,QUANTITY,DATE\n'
+                ' 638700000001,3,X\n'
+                '638700000002, 4,X\n'
+                '+638700000003,+5 ,X\n'
+                '638700000004,1_0,X\n'
+                '638700000005,-,X\n'
+                '638700000006,99999999999999999999,X\n'
+                '638700000007,,X\n'
+                ' 12,1,X\n'
+                ',2,X\n'
+                '638700000008\n').encode('utf8')
+        rows = CSVRows(data, 'Inventory', columns=('UPC', 'QUANTITY'))
+        expected = [dict(r) for r in rows]
+        columns = columnar.InventoryColumns.from_bytes(data)
+        self.assertEqual(list(columns), expected)
+        self.assertEqual([r['QUANTITY'] for r in expected],
+                         [3, 4, 5, 10, 0, 0, 0, 0])
+
+        self.assertEqual(columns.errors.count, rows.errors.count)
+        self.assertEqual(columns.errors.counts_by_column,
+                         {'QUANTITY': 2, 'UPC': 2})
+        self.assertEqual(columns.errors.counts_by_column,
+                         rows.errors.counts_by_column)
+        self.assertEqual(columns.errors.samples, rows.errors.samples)
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'inventory.csv')
+            with open(path, 'wb') as f:
+                f.write(inventory_csv)
+            self.assertEqual(
+                list(columnar.InventoryColumns.from_file(path)),
+                list(columnar.InventoryColumns.from_bytes(inventory_csv)))
+
+            open(path, 'wb').close()
+            self.assertEqual(len(columnar.InventoryColumns.from_file(path)), 0)
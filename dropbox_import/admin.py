@@ -1,23 +1,18 @@
-import logging, pytz
+import logging
 from pprint import pprint, pformat
 
-import dropbox
 from django.contrib import admin
 from django.urls import path, reverse
 from django.http import HttpResponseRedirect
 from django.utils.html import format_html
 from django.contrib import messages
-from django.utils.timezone import make_aware
 
-from interfaces import DropboxInterface
-from core.models import Company
 from core.controllers import Controller
-from .models import ImportFile, ExportType, ImportJob
+from .models import ImportFile, ImportJob
 from db_logger.models import DBLogEntry
 
 
 log = logging.getLogger('development')
-dropbox_interface = DropboxInterface()
 current_app_name = __package__.rsplit('.', 1)[-1]
 controller = Controller()
 
@@ -166,7 +161,9 @@ class ImportFileAdmin(ImportAdminBase):
         # User has clicked on the export to shopify button. We should have a
         # valid ImportFile id.
         try:
-            message = controller.start_shopify_export(import_file_id)
+            # Exports started by a user always run.
+            message = controller.start_shopify_export(import_file_id,
+                                                      force=True)
         # Handle error conditions and notify the user
         except ImportFile.DoesNotExist as e:
             message = 'Import file with pk={} not found.'.format(
@@ -190,82 +187,23 @@ class ImportFileAdmin(ImportAdminBase):
     def load_files(self, request):
         """Loads import files from Dropbox.
         """
-
-        # TODO: Refactor this into the controller. Only keep logic related to
-        # Admin UI.
-
         redirect_url = request.META['HTTP_REFERER']
 
-        # list all files in the dropbox export folder
-        entries = dropbox_interface.list_all_files()
-
-        # make sure we have some files to import
-        if entries == None:
+        try:
+            numb_created, numb_updated, numb_deleted = (
+                controller.load_files_from_dropbox())
+        except Exception as e:
+            log.exception(e)
             self.message_user(
                 request,
-                'No data files found in dropbox folder {}.'.format(
-                    settings.DROPBOX_EXPORT_FOLDER),
-                messages.WARNING)
-            return HttpResponseRedirect("../")
-
-        for filemeta in entries:
-            log.debug(pformat(filemeta))
-
-            # skip non-files
-            if type(filemeta) != dropbox.files.FileMetadata:
-                continue
-
-            # get the company and export type
-            try:
-                company_name, export_type_name = ImportFile.parse_company_export_type(filemeta.name)
-            except ValueError as e:
-                # skip any files that don't have company and export types
-                log.warning(e)
-                continue
-
-            try:
-                company, created = Company.objects.get_or_create(
-                    name=company_name)
-            except ValueError as e:
-                log.warning(e)
-            except Exception as e:
-                log.exception(e)
-                return
-
-            try:
-                export_type, created = ExportType.objects.get_or_create(
-                    name=export_type_name)
-            except ValueError as e:
-                log.warning(e)
-            except Exception as e:
-                log.exception(e)
-                return
-
-            try:
-                import_file, created = ImportFile.objects.update_or_create(
-                    dropbox_id=filemeta.id,
-                    defaults={
-                        'path_lower': filemeta.path_lower,
-                        'filename': filemeta.name,
-                        'server_modified': make_aware(filemeta.server_modified, timezone=pytz.UTC),
-                        'company': company,
-                        'export_type': export_type,})
-            except ValueError as e:
-                log.warning(e)
-            except Exception as e:
-                log.exception(e)
-                return
-
-        # delete ImportFiles from database that are not in dropbox
-
-        # create a list of dropbox file ids
-        entry_ids = [ e.id for e in entries]
-
-        # loop over the files in the database, check each db file dropbox_id
-        # if it is not in the list of dropbox file ids, then we delete it.
-        ImportFile.objects.exclude(dropbox_id__in=entry_ids).delete()
-        
-        self.message_user(request, "Import Files have been loaded.")
+                'There was an error loading the Import Files from Dropbox.',
+                messages.ERROR)
+            return HttpResponseRedirect(redirect_url)
+
+        self.message_user(
+            request,
+            'Import Files have been loaded. {} created, {} updated, {} '
+            'deleted.'.format(numb_created, numb_updated, numb_deleted))
         return HttpResponseRedirect(redirect_url)
 
 
@@ -7,6 +7,10 @@ needed for the various destinations.
 """
 
 import re, logging
+from datetime import timedelta
+
+from django.conf import settings
+
 from interfaces import ShopifyInterface, RedisInterface
 from core.models import Inventory
 from csv_parser.helpers import is_upc_valid
@@ -16,18 +20,34 @@ log = logging.getLogger('django')
 class InventoryExporter():
     """
     Export the latest inventory data to the shops for each company.
+
+    In delta mode only the variants whose UPC was added, removed, or changed
+    quantity since the last successful export are updated. Every variant is
+    updated when there is no exported inventory to compare with, or when the
+    last full export is older than INVENTORY_FULL_SYNC_HOURS. Those full
+    exports also correct any levels that were changed in Shopify directly.
     """
 
-    def __init__(self, company, fulfillment_service_id):
+    def __init__(self, company, fulfillment_service_id, delta=True, shop=None):
         self.company = company
+        self.delta = delta
         self.fulfillment_service_id = fulfillment_service_id
         self.inventory = Inventory(company.name)
-        self.shop = ShopifyInterface(
-            shop_url=company.shop_url,
-            fulfillment_service_id=fulfillment_service_id)
+        # Reuse the caller's ShopifyInterface and its loaded catalog if given.
+        if shop is None:
+            shop = ShopifyInterface(
+                shop_url=company.shop_url,
+                fulfillment_service_id=fulfillment_service_id)
+        self.shop = shop
         self._numb_products_updated = 0
+        # UPC to quantity mapping, loaded from Redis in one fetch on first use.
+        self._quantities = None
 
     def export_data(self):
+        version = self.inventory.get_current_version()
+        self._quantities = self.inventory.get_quantities(version)
+        changed_upcs = self.get_changed_upcs()
+        level_updates = []
 
         for variant_id, variant in self.shop.variants.items():
             save_needed = False
@@ -41,8 +61,19 @@ class InventoryExporter():
                 invalid_upcs.append(upc)
                 continue
 
-            self.shop.set_level_available(variant,
-                                          self.get_quantity_by_upc(upc))
+            # skip the unchanged variants in a delta export
+            if changed_upcs is not None and str(upc) not in changed_upcs:
+                continue
+
+            level_updates.append((variant, self.get_quantity_by_upc(upc)))
+
+        # Send the new levels to Shopify in batches.
+        numb_failed = 0
+        for result in self.shop.set_levels_available(level_updates):
+            if result.error:
+                numb_failed += 1
+                log.warning('Unable to set inventory item {} to {}: {}'.format(
+                    result.inventory_item_id, result.available, result.error))
 
         # TODO: Do I need to use this? Could I just leave the product_type
         # alone?
@@ -57,26 +88,43 @@ class InventoryExporter():
                     # out of stock, make sure it goes in the lookbook
                     self.shop.update_product(p, 'product_type', 'Theia Collection')
 
-        # Reset the current inventory.
-        self.inventory.reset()
-        
+        # A failed update would be missing from the next delta export if this
+        # inventory was kept, so the last exported one is compared with again.
+        if numb_failed:
+            log.warning('{} inventory levels failed to update, the next export '
+                        'will retry them.'.format(numb_failed))
+        else:
+            # Keep this inventory to compare the next import with.
+            if version is not None:
+                self.inventory.mark_exported(version)
+            if changed_upcs is None:
+                self.inventory.mark_full_sync()
+
         log.info('Shopify Products Updated: {}'.format(self._numb_products_updated))
 
+    def get_changed_upcs(self):
+        """Returns the set of UPCs that need updating or None for all of them.
+        """
+        if not self.delta:
+            return None
+        if self.inventory.needs_full_sync(
+                timedelta(hours=settings.INVENTORY_FULL_SYNC_HOURS)):
+            return None
+        exported = self.inventory.get_exported_quantities()
+        if exported is None:
+            return None
+
+        diff = self.inventory.diff(exported, self._quantities)
+        log.info('{} inventory changes: {} added, {} removed, {} changed'.format(
+            self.company.name,
+            len(diff.added), len(diff.removed), len(diff.changed)))
+        return diff.added | diff.removed | diff.changed
+
     def get_quantity_by_upc(self, upc):
-        try:
-            quantity = self.inventory.get_item_value(upc, 'QUANTITY')
-        except Exception as e:
-            log.exception(e)
-            log.warning('Unable to get quantity with upc: {}'.format(upc))
-        else:
-            try:
-                return int(quantity)
-            except Exception as e:
-                log.exception(e)
-                log.warning(
-                    'Unable to cast quantity value: {} to in for upc: {}'.format(
-                        quantity, upc))
-        return 0
+        if self._quantities is None:
+            self._quantities = self.inventory.get_quantities()
+        # UPCs missing from the inventory file are out of stock.
+        return self._quantities.get(str(upc), 0)
 
     def is_product_in_stock(self, product):
         # get a list of variants for this product
@@ -1,6 +1,8 @@
 import logging, re
+from contextlib import ExitStack
 
-from core.models import Inventory
+from core.models import Inventory, ProductVariants
+from csv_parser.models import ProductVariantRows
 
 
 log = logging.getLogger('development')
@@ -14,6 +16,10 @@ then process all the lines of that file to create the needed objects
 """
 
 class ImporterBase:
+    # The columns process_row() uses, the rows are parsed with only these
+    # columns. None for all of them.
+    columns = None
+
     def __init__(self, company=None, rows=None):
         self.rows = rows
         self.company = company
@@ -24,11 +30,20 @@ class ImporterBase:
     def import_data(self):
         self.pre_import_data()
 
-        for row in self.rows:
-            self.process_row(row)
+        with self.batch():
+            for row in self.rows:
+                self.process_row(row)
 
         self.post_import_data()
 
+    def batch(self):
+        """Returns the context manager the rows are processed in.
+
+        Importers that write to a store return its batched writer here. The
+        default does nothing.
+        """
+        return ExitStack()
+
     def post_import_data(self):
         pass
 
@@ -46,28 +61,82 @@ class InventoryImporter(ImporterBase):
     """
 
     missing_upcs = 0
+    # Only these values are stored in Redis for each item.
+    columns = ('UPC', 'QUANTITY')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, publish=True, **kwargs):
+        """With publish=False the imported snapshot is left staged until
+        publish() is called."""
         super().__init__(*args, **kwargs)
         self.inventory = Inventory(self.company.name)
+        self.auto_publish = publish
 
     def pre_import_data(self):
-        self.inventory.reset()
+        # The rows are staged in a new snapshot. The current inventory stays
+        # readable until the import is complete.
+        self.inventory.begin_snapshot()
         super().pre_import_data()
 
     def import_data(self, *args, **kwargs):
         super().import_data(*args, **kwargs)
 
+    def batch(self):
+        return self.inventory.batch_writes()
+
     def post_import_data(self):
+        if self.auto_publish:
+            self.publish()
         super().post_import_data()
 
+    def publish(self):
+        return self.inventory.publish_snapshot()
+
+    def discard(self):
+        """Drops the staged snapshot if it hasn't been published."""
+        self.inventory.discard_snapshot()
+
     def process_row(self, row):
-        upc = row['UPC']
-
-        # upc might be set to None
-        # TODO: Move this check to the CSVRows model. We should filter all bad
-        # data out there. This Importer should only take sanitized data and
-        # save it to Redis.
-        if upc:
-            # store upc in redis set
-            self.inventory.add_item(upc, row)
+        # The rows without a valid UPC are skipped by CSVRows and
+        # InventoryColumns.
+        self.inventory.add_item(row['UPC'], row)
+
+
+class ProductImporter(ImporterBase):
+    """
+    Import the variants of a Product file to redis
+
+    rows is a ProductVariantRows, each VariantRecord is stored in a hash keyed
+    by its UPC
+    """
+
+    # The columns ProductVariantRows reads from the Product file.
+    columns = ProductVariantRows.columns
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.variants = ProductVariants(self.company.name)
+
+    def pre_import_data(self):
+        # The current variants stay readable until the import is complete.
+        self.variants.begin_snapshot()
+        super().pre_import_data()
+
+    def batch(self):
+        return self.variants.batch_writes()
+
+    def post_import_data(self):
+        self.variants.publish_snapshot()
+        super().post_import_data()
+
+    def discard(self):
+        """Drops the staged snapshot if it hasn't been published."""
+        self.variants.discard_snapshot()
+
+    def process_row(self, variant):
+        item = {'STYLE NUMBER': variant.style_number,
+                'COLOR CODE': variant.color_code,
+                'SIZE': variant.size}
+        # Columns missing from the file are left out of the hash.
+        self.variants.add_item(
+            variant.upc,
+            {k: v for k, v in item.items() if v is not None})
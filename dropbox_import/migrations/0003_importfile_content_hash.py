@@ -0,0 +1,18 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dropbox_import', '0002_auto_20181013_1826'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importfile',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.1 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dropbox_import', '0003_importfile_content_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='importjob',
+            name='status',
+            field=models.CharField(choices=[('NOT_STARTED', 'Not Started'), ('RUNNING', 'Running'), ('SUCCESS', 'Completed Successfully'), ('ERROR', 'Error - Not Completed'), ('SUPERSEDED', 'Superseded by a Newer File')], default='NOT_STARTED', max_length=16),
+        ),
+    ]
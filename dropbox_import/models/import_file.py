@@ -39,6 +39,8 @@ class ImportFile(models.Model):
     import_status = models.CharField(max_length=16,
                                      choices=IMPORT_STATUS_CHOICES,
                                      default=NOT_IMPORTED)
+    # Dropbox content_hash of the file data
+    content_hash = models.CharField(max_length=64, blank=True, default='')
 
     @property
     def content(self):
@@ -62,6 +64,56 @@ class ImportFile(models.Model):
                 'Company or export type not found in filename: {}'
                 .format(filename))
 
+    def get_last_exported_file(self):
+        """Returns the file of the last successful ImportJob for the same
+        company and export type, or None."""
+        job = ImportJob.objects.filter(
+            status=ImportJob.SUCCESS,
+            import_file__company=self.company,
+            import_file__export_type=self.export_type,
+        ).order_by('-end_time').first()
+        if job is None:
+            return None
+        return job.import_file
+
+    def is_content_exported(self):
+        """True if this file's data is the same as the last exported file.
+        """
+        if not self.content_hash:
+            return False
+        last_file = self.get_last_exported_file()
+        return (last_file is not None
+                and last_file.content_hash == self.content_hash)
+
+    def get_older_files(self):
+        """Returns the files for the same company and export type that are
+        older than this one."""
+        return self.__class__.objects.filter(
+            company=self.company,
+            export_type=self.export_type,
+            server_modified__lt=self.server_modified)
+
+    def is_superseded(self):
+        """True if there is a newer file for the same company and export
+        type."""
+        return self.__class__.objects.filter(
+            company=self.company,
+            export_type=self.export_type,
+            server_modified__gt=self.server_modified).exists()
+
+    def supersede_older_files(self):
+        """Expires the older files that haven't been imported and
+        supersedes their pending ImportJobs, so only this file's data is
+        exported."""
+        older_files = self.get_older_files()
+        older_files.filter(import_status=self.NOT_IMPORTED).update(
+            import_status=self.EXPIRED)
+        jobs = ImportJob.objects.filter(
+            import_file__in=older_files,
+            status__in=[ImportJob.NOT_STARTED, ImportJob.RUNNING])
+        for job in jobs:
+            job.supersede()
+
     def is_importing(self):
         # Get ImportJob instances for this ImportFile. There really should only
         # be one but we do it this way to avoid possible Exceptions.
@@ -1,7 +1,7 @@
 import logging
 from pprint import pprint, pformat
 
-from celery import shared_task
+from celery import current_app, shared_task
 from django.db import models
 from django.utils import timezone
 
@@ -18,10 +18,12 @@ class ImportJob(models.Model):
     RUNNING = 'RUNNING'
     SUCCESS = 'SUCCESS'
     ERROR = 'ERROR'
+    SUPERSEDED = 'SUPERSEDED' # A job for a newer file replaced this one
     STATUS_CHOICES = ((NOT_STARTED, 'Not Started'),
                       (RUNNING, 'Running'),
                       (SUCCESS, 'Completed Successfully'),
-                      (ERROR, 'Error - Not Completed'),)
+                      (ERROR, 'Error - Not Completed'),
+                      (SUPERSEDED, 'Superseded by a Newer File'),)
 
     status = models.CharField(max_length=16,
                               choices=STATUS_CHOICES,
@@ -60,6 +62,9 @@ class ImportJob(models.Model):
         return self
 
     def finish(self, msg=False, err=False):
+        # Superseded jobs keep their status when their task returns.
+        if self.status == self.SUPERSEDED:
+            return
         if err:
             self.status = self.ERROR
         else:
@@ -69,6 +74,23 @@ class ImportJob(models.Model):
         self.end_time = timezone.now()
         self.save()
 
+    def supersede(self, msg='Superseded by a newer file.'):
+        """Marks the job as replaced by the job of a newer file.
+
+        The celery task is revoked, so it's skipped if it hasn't started. A
+        task that is already running stops when it sees its file is
+        superseded.
+        """
+        if self.celery_task_id:
+            try:
+                current_app.control.revoke(self.celery_task_id)
+            except Exception as e:
+                log.exception(e)
+        self.status = self.SUPERSEDED
+        self.end_time = timezone.now()
+        self.save()
+        dblog.info(msg, self.pk)
+
     def __repr__(self):
         return '{}({})'.format(
             self.__class__.__name__, self.pk)
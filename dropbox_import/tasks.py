@@ -16,6 +16,29 @@ log = logging.getLogger('development')
 controller = Controller()
 
 
+@shared_task(bind=True)
+def handle_dropbox_changes(self):
+    """Processes the changed Dropbox files for a webhook notification.
+
+    The webhook view queues this task and replies to Dropbox right away, so
+    the listing and the ImportFile updates don't delay the response. The
+    notification is recorded by the view with DropboxInterface.notify_changes
+    so the tasks queued by a burst of notifications share a single run.
+    """
+    log.debug('Calling handle_dropbox_changes task')
+    # Bursts of notifications are coalesced into as few runs as possible.
+    DropboxInterface().process_changes(
+        controller.handle_dropbox_file_change_notification)
+
+
+@shared_task(bind=True)
+def delete_expired_files(self):
+    """Deletes the import files older than DROPBOX_RETENTION_DAYS, run daily
+    by celery beat."""
+    log.debug('Calling delete_expired_files task')
+    controller.delete_expired_files()
+
+
 @shared_task(bind=True)
 def process_inventory_file(self, import_file):
     log.debug('Calling process_inventory_file task')
@@ -65,9 +88,10 @@ def process_inventory_file(self, import_file):
     # the data into Redis.
     importer = InventoryImporter(
         company=company,
-        rows=CSVRows(
-            response.content,
-            import_file['export_type']))
+        rows=CSVRows.from_response(
+            response,
+            import_file['export_type'],
+            columns=InventoryImporter.columns))
     importer.import_data()
 
     exporter = InventoryExporter(company=company,
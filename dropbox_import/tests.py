@@ -1,19 +1,30 @@
-from django.test import TestCase
+import hmac, json
+from datetime import timedelta
+from hashlib import sha256
+from unittest import mock
+
+from django.test import TestCase, SimpleTestCase, override_settings
 from django.utils import timezone
 from core.celery import test_task
+from core.models import Company, Inventory, ProductVariants
+from csv_parser.models import VariantRecord
+from interfaces.shopify_interface import LevelUpdate
+from .exporters import InventoryExporter
+from .importers import ProductImporter
 from .models import ImportFile, ExportType, ImportJob, ImportJobLogEntry
 from .db_logger import DBLogger
 
 
-def create_file(export_type):
+def create_file(export_type, dropbox_id='testfile', **kwargs):
     """Create and return a testing file.
     """
+    kwargs.setdefault('server_modified', timezone.now())
     return ImportFile.objects.create(
-        dropbox_id='testfile',
-        path_lower='testfile',
+        dropbox_id=dropbox_id,
+        path_lower=dropbox_id,
         filename='TestFile',
-        server_modified=timezone.now(),
-        export_type=export_type,)
+        export_type=export_type,
+        **kwargs)
 
 
 def create_import_job(import_file):
@@ -42,6 +53,58 @@ class ImportFileTest(TestCase):
         job.save()
         self.assertTrue(file.is_importing())
 
+    def test_is_content_exported(self):
+        company = Company.objects.create(name='TestingCompany')
+        first = create_file(self.export_type, 'first', company=company,
+                            content_hash='a' * 64)
+        self.assertFalse(first.is_content_exported())
+        job = create_import_job(import_file=first)
+        job.finish()
+
+        # Same data uploaded again.
+        second = create_file(self.export_type, 'second', company=company,
+                             content_hash='a' * 64)
+        self.assertTrue(second.is_content_exported())
+
+        changed = create_file(self.export_type, 'changed', company=company,
+                              content_hash='b' * 64)
+        self.assertFalse(changed.is_content_exported())
+        job = create_import_job(import_file=changed)
+        job.finish()
+        # Only compared with the last exported file.
+        self.assertFalse(second.is_content_exported())
+
+    @mock.patch('dropbox_import.models.import_job.current_app')
+    def test_supersede_older_files(self, app):
+        company = Company.objects.create(name='TestingCompany')
+        now = timezone.now()
+        old = create_file(self.export_type, 'old', company=company,
+                          server_modified=now - timedelta(minutes=5))
+        imported = create_file(self.export_type, 'imported', company=company,
+                               server_modified=now - timedelta(minutes=10),
+                               import_status=ImportFile.IMPORTED)
+        new = create_file(self.export_type, 'new', company=company,
+                          server_modified=now)
+        self.assertTrue(old.is_superseded())
+        self.assertFalse(new.is_superseded())
+
+        job = create_import_job(import_file=old)
+        job.status = ImportJob.RUNNING
+        job.celery_task_id = 'task'
+        job.save()
+        new.supersede_older_files()
+
+        old.refresh_from_db()
+        imported.refresh_from_db()
+        job.refresh_from_db()
+        self.assertEqual(old.import_status, ImportFile.EXPIRED)
+        self.assertEqual(imported.import_status, ImportFile.IMPORTED)
+        self.assertEqual(job.status, ImportJob.SUPERSEDED)
+        app.control.revoke.assert_called_once_with('task')
+        # The job stays superseded when its task finishes.
+        job.finish()
+        self.assertEqual(job.status, ImportJob.SUPERSEDED)
+
 class ImportJobTest(TestCase):
 
     @classmethod
@@ -84,3 +147,97 @@ class DBLoggerTest(TestCase):
         entry = ImportJobLogEntry.objects.get(import_job=job.pk)
         self.assertEqual('hello world', entry.message)
         self.assertEqual(ImportJobLogEntry.INFO, entry.level)
+
+
+@override_settings(DROPBOX_APP_SECRET='secret')
+class WebhookNotificationTest(SimpleTestCase):
+
+    url = '/webhook/dropbox-updated/'
+
+    def post(self, body, signature=None):
+        if signature is None:
+            signature = hmac.new(b'secret', body, sha256).hexdigest()
+        return self.client.post(self.url, body,
+                                content_type='application/json',
+                                HTTP_X_DROPBOX_SIGNATURE=signature)
+
+    @mock.patch('dropbox_import.views.dropbox_interface')
+    @mock.patch('dropbox_import.views.handle_dropbox_changes')
+    def test_queues_changes(self, task, dropbox_interface):
+        body = json.dumps({'list_folder': {'accounts': ['id']}}).encode()
+        response = self.post(body)
+        self.assertEqual(response.status_code, 200)
+        dropbox_interface.notify_changes.assert_called_once_with()
+        task.delay.assert_called_once_with()
+
+    @mock.patch('dropbox_import.views.handle_dropbox_changes')
+    def test_invalid_signature(self, task):
+        response = self.post(b'{}', signature='bogus')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(task.delay.called)
+
+
+class InventoryExporterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.inventory = Inventory('TestingCompany')
+        self.inventory.reset()
+        self.inventory.redis.client.delete(
+            self.inventory.redis.format_key('full_sync'))
+        self.inventory.add_item('638700000001', {'QUANTITY': 1})
+        self.inventory.add_item('638700000002', {'QUANTITY': 2})
+        self.version = self.inventory.publish_snapshot()
+
+        self.shop = mock.Mock()
+        self.shop.variants = {
+            1: mock.Mock(barcode='638700000001', inventory_item_id=11),
+            2: mock.Mock(barcode='638700000002', inventory_item_id=12),}
+
+    def tearDown(self):
+        self.inventory.reset()
+
+    def export(self, errors):
+        self.shop.set_levels_available.return_value = [
+            LevelUpdate(11, 1, errors.get(11)),
+            LevelUpdate(12, 2, errors.get(12)),]
+        company = mock.Mock()
+        company.name = 'TestingCompany'
+        InventoryExporter(company, 1, shop=self.shop).export_data()
+
+    def test_export_data(self):
+        self.export({})
+        self.assertEqual(self.inventory.get_exported_version(), self.version)
+        self.assertFalse(self.inventory.needs_full_sync(timedelta(hours=1)))
+
+    def test_failed_levels_are_not_exported(self):
+        self.export({12: 'Not stocked at the location.'})
+        self.assertIsNone(self.inventory.get_exported_version())
+        self.assertTrue(self.inventory.needs_full_sync(timedelta(hours=1)))
+
+
+class ProductImporterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.variants = ProductVariants('TestingCompany')
+        self.variants.reset()
+        self.company = mock.Mock()
+        self.company.name = 'TestingCompany'
+
+    def tearDown(self):
+        self.variants.reset()
+
+    def test_import_data(self):
+        importer = ProductImporter(company=self.company, rows=[
+            VariantRecord(880001, 'NVY', 0, 638700000001),
+            VariantRecord(880001, None, 2, 638700000002),])
+        importer.import_data()
+        importer.discard()
+
+        self.assertEqual(self.variants.get_item_values('SIZE'),
+                         {'638700000001': '0', '638700000002': '2'})
+        self.assertEqual(
+            self.variants.get_item(638700000001),
+            {'STYLE NUMBER': '880001', 'COLOR CODE': 'NVY', 'SIZE': '0'})
+        self.assertEqual(
+            self.variants.get_item(638700000002),
+            {'STYLE NUMBER': '880001', 'SIZE': '2'})
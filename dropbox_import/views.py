@@ -4,13 +4,12 @@ from hashlib import sha256
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.conf import settings
 
-from core.controllers import Controller
 from interfaces import DropboxInterface
-from .tasks import process_inventory_file
+from .tasks import handle_dropbox_changes
 
 
 log = logging.getLogger('development')
-controller = Controller()
+dropbox_interface = DropboxInterface()
 
 
 """Dropbox webhook handling functions
@@ -54,8 +53,11 @@ def process_webhook_notification(request):
     # If we need to expand this app to multiple accounts and users we'd need
     # this data.
 
+    # The changes are processed by a worker so we can reply to Dropbox
+    # within its 10 second timeout regardless of the number of files.
     try:
-        controller.handle_dropbox_file_change_notification()
+        dropbox_interface.notify_changes()
+        handle_dropbox_changes.delay()
     except Exception as e:
         log.exception(e)
 
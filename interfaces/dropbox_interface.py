@@ -1,24 +1,47 @@
-import logging, re, os, dropbox, redis
+import logging, re, os, time, dropbox, redis
 from datetime import timedelta
 from pprint import pprint, pformat
 
 from django.conf import settings
 
+from .file_cache import FileCache
+
 
 log = logging.getLogger('development')
 
+# Size of the chunks read from a download response.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 class DropboxInterface:
 
     redis_namespace = 'dropbox'
     cursor_key_format = '{prefix}:cursor'
+    changes_lock_key_format = '{prefix}:changes:lock'
+    changes_pending_key_format = '{prefix}:changes:pending'
+    # Longest time a run of the changes can hold the lock, a full rescan of
+    # the folder may be needed if the cursor is missing.
+    changes_lock_timeout = 600
+    # Seconds each longpoll request waits for changes, between 30 and 480.
+    longpoll_timeout = 60
+    # Seconds watch_changes() waits after an error or while another run is
+    # processing the changes.
+    watch_retry_delay = 1
+    # Most paths Dropbox accepts in one batch delete.
+    delete_batch_size = 1000
+    # Seconds between checks of a batch delete job.
+    delete_poll_interval = 1
 
     def __init__(self):
         self.dropbox_client = dropbox.Dropbox(settings.DROPBOX_TOKEN)
+        # Dropbox adds up to 90 seconds of jitter to the longpoll timeout.
+        self.longpoll_client = dropbox.Dropbox(
+            settings.DROPBOX_TOKEN, timeout=self.longpoll_timeout + 90)
         self.redis_client = redis.StrictRedis(host=settings.REDIS_DOMAIN,
                                                    db=settings.REDIS_DB,
                                                    port=settings.REDIS_PORT)
         self.__cursor = None
+        self.file_cache = FileCache()
 
     # Upload, Delete, and Get Files
     def upload_files(self, files, path='/'):
@@ -30,9 +53,80 @@ class DropboxInterface:
     def delete_file(self, path):
         self.dropbox_client.files_delete(path)
 
+    def delete_files(self, paths):
+        """Deletes files with the batch delete API.
+
+        Dropbox runs each batch as an async job that is polled until it is
+        done. Returns the paths that no longer exist, including the ones that
+        were already deleted.
+        """
+        deleted = []
+        for i in range(0, len(paths), self.delete_batch_size):
+            batch = paths[i:i + self.delete_batch_size]
+            launch = self.dropbox_client.files_delete_batch(
+                [dropbox.files.DeleteArg(path) for path in batch])
+            if launch.is_complete():
+                result = launch.get_complete()
+            else:
+                result = self._wait_for_delete_batch(launch.get_async_job_id())
+            if result is None:
+                continue
+
+            for path, entry in zip(batch, result.entries):
+                if entry.is_success() or _is_not_found(entry.get_failure()):
+                    deleted.append(path)
+                else:
+                    log.warning('Unable to delete {}: {}'.format(
+                        path, entry.get_failure()))
+        return deleted
+
     def download_file(self, id):
         return self.dropbox_client.files_download(id)
 
+    def download_to_cache(self, id, content_hash=None):
+        """Returns the local path of a file's data.
+
+        The file is only downloaded from Dropbox if it isn't already in the
+        file cache. Without a content_hash the file is always downloaded.
+        """
+        if content_hash:
+            path = self.file_cache.get(content_hash)
+            if path is not None:
+                log.debug('Using cached file {}'.format(path))
+                return path
+
+        filemeta, response = self.download_file(id)
+        try:
+            return self.file_cache.put(
+                filemeta.content_hash,
+                response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE))
+        finally:
+            response.close()
+
+    def download_chunks(self, id, content_hash=None,
+                        chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Yields a file's data in byte chunks.
+
+        A file in the file cache is read from disk. Otherwise the chunks are
+        yielded as they are downloaded and written to the cache at the same
+        time, so the data can be parsed without waiting for the whole file.
+        """
+        if content_hash:
+            path = self.file_cache.get(content_hash)
+            if path is not None:
+                log.debug('Using cached file {}'.format(path))
+                with open(path, 'rb') as f:
+                    yield from iter(lambda: f.read(chunk_size), b'')
+                return
+
+        filemeta, response = self.download_file(id)
+        try:
+            yield from self.file_cache.tee(
+                filemeta.content_hash,
+                response.iter_content(chunk_size=chunk_size))
+        finally:
+            response.close()
+
     def get_file_contents(self, id):
         filemeta, response = self.download_file(id)
         return response.text
@@ -64,8 +158,110 @@ class DropboxInterface:
         self._save_cursor(cursor)
         return entries
 
+    def notify_changes(self):
+        """Records that Dropbox has sent a change notification."""
+        self.redis_client.set(self._format_changes_key(
+            self.changes_pending_key_format), 1)
+
+    def process_changes(self, handler):
+        """Calls handler() once for any number of pending notifications.
+
+        Only one run is active at a time, it holds a lock in Redis while it
+        lists the changes and updates the cursor. Notifications that arrive
+        during a run are handled by a single follow up run of the active one.
+        Returns False if another run was already active.
+        """
+        pending_key = self._format_changes_key(
+            self.changes_pending_key_format)
+        while True:
+            lock = self.redis_client.lock(
+                self._format_changes_key(self.changes_lock_key_format),
+                timeout=self.changes_lock_timeout)
+            if not lock.acquire(blocking=False):
+                log.debug('Dropbox changes are already being processed.')
+                return False
+            try:
+                # Clear the flag before the run so a notification during the
+                # run sets it again.
+                while self.redis_client.delete(pending_key):
+                    try:
+                        handler()
+                    except Exception:
+                        # Keep the changes pending for the next run.
+                        self.redis_client.set(pending_key, 1)
+                        raise
+            finally:
+                try:
+                    lock.release()
+                except redis.exceptions.LockError:
+                    log.warning('Dropbox changes lock expired during run.')
+            # A notification could have been skipped while the lock was
+            # being released.
+            if not self.redis_client.exists(pending_key):
+                return True
+
+    def watch_changes(self, handler, stop=None):
+        """Processes the changes in the export folder as they happen.
+
+        An alternative to the webhook that needs no inbound requests. Waits
+        on the Dropbox longpoll endpoint with the cursor stored in Redis and
+        runs handler through process_changes() when files change, the same
+        way as the webhook notifications. Runs until stop, a threading.Event,
+        is set.
+        """
+        while stop is None or not stop.is_set():
+            backoff = None
+            cursor = self._get_cursor()
+            if cursor is None:
+                # handler lists the whole folder and saves a new cursor.
+                changes = True
+            else:
+                try:
+                    result = self.longpoll_client.files_list_folder_longpoll(
+                        cursor, timeout=self.longpoll_timeout)
+                except dropbox.exceptions.ApiError as e:
+                    # The cursor is no longer valid, start again with a
+                    # full listing.
+                    log.warning(e)
+                    self._delete_cursor()
+                    continue
+                except Exception as e:
+                    log.exception(e)
+                    time.sleep(self.watch_retry_delay)
+                    continue
+                changes = result.changes
+                backoff = result.backoff
+
+            if changes:
+                self.notify_changes()
+                try:
+                    if not self.process_changes(handler):
+                        # The active run will update the cursor.
+                        time.sleep(self.watch_retry_delay)
+                except Exception as e:
+                    log.exception(e)
+                    time.sleep(self.watch_retry_delay)
+
+            # Dropbox asks clients to wait before polling again under load.
+            if backoff:
+                time.sleep(backoff)
+
     # Private Methods #########################################################
 
+    def _wait_for_delete_batch(self, async_job_id):
+        while True:
+            status = self.dropbox_client.files_delete_batch_check(async_job_id)
+            if status.is_complete():
+                return status.get_complete()
+            if status.is_failed():
+                log.error('Dropbox batch delete failed: {}'.format(
+                    status.get_failed()))
+                return None
+            time.sleep(self.delete_poll_interval)
+
+    def _format_changes_key(self, key_format):
+        return key_format.format(prefix=self.redis_namespace)
+
     def _format_cursor_key(self):
         return self.cursor_key_format.format(
             prefix=self.redis_namespace)
@@ -104,7 +300,7 @@ class DropboxInterface:
             if cursor is not None:
                 try:
                     result = self.dropbox_client.files_list_folder_continue(cursor)
-                except ApiError:
+                except dropbox.exceptions.ApiError:
                     # invalid cursor so we set to None and get the full folder list
                     cursor = None
 
@@ -216,3 +412,7 @@ class DropboxInterface:
             raise ValueError(
                 'Company or export type not found in filename: {}'
                 .format(filename))
+
+
+def _is_not_found(error):
+    return error.is_path_lookup() and error.get_path_lookup().is_not_found()
@@ -0,0 +1,128 @@
+import hashlib, logging, os, tempfile
+
+from django.conf import settings
+
+
+log = logging.getLogger('development')
+
+# Dropbox hashes the file data in blocks of this size.
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class DropboxContentHasher:
+    """Computes the Dropbox content_hash of data fed in any size of chunks.
+
+    https://www.dropbox.com/developers/reference/content-hash
+    """
+
+    def __init__(self):
+        self._overall = hashlib.sha256()
+        self._block = hashlib.sha256()
+        self._block_pos = 0
+
+    def update(self, data):
+        pos = 0
+        while pos < len(data):
+            if self._block_pos == DROPBOX_HASH_BLOCK_SIZE:
+                self._overall.update(self._block.digest())
+                self._block = hashlib.sha256()
+                self._block_pos = 0
+            part = data[pos:pos + DROPBOX_HASH_BLOCK_SIZE - self._block_pos]
+            self._block.update(part)
+            self._block_pos += len(part)
+            pos += len(part)
+
+    def hexdigest(self):
+        overall = self._overall.copy()
+        if self._block_pos > 0:
+            overall.update(self._block.digest())
+        return overall.hexdigest()
+
+
+class FileCache:
+    """Disk cache of import files keyed by their Dropbox content_hash.
+
+    Files are only added once their data matches the hash, so a cached file
+    never needs to be checked against Dropbox again. Reading a file marks it
+    as recently used and the least recently used files are removed when the
+    cache is larger than max_size bytes.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or settings.IMPORT_FILE_CACHE_DIR
+        if max_size is None:
+            max_size = settings.IMPORT_FILE_CACHE_MAX_SIZE
+        self.max_size = max_size
+
+    def get(self, content_hash):
+        """Returns the path of a cached file or None if it isn't cached."""
+        path = self._format_path(content_hash)
+        try:
+            # The modification time tracks the last use.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, content_hash, chunks):
+        """Writes the byte chunks to the cache and returns the file's path.
+
+        Raises ValueError if the data doesn't match content_hash.
+        """
+        for chunk in self.tee(content_hash, chunks):
+            pass
+        return self._format_path(content_hash)
+
+    def tee(self, content_hash, chunks):
+        """Yields the byte chunks while they are written to the cache.
+
+        The file is added once the last chunk has been yielded and its data
+        matches content_hash, otherwise ValueError is raised. Nothing is added
+        if the chunks aren't all consumed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        hasher = DropboxContentHasher()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    yield chunk
+            if hasher.hexdigest() != content_hash:
+                raise ValueError(
+                    'Downloaded data does not match content hash {}'.format(
+                        content_hash))
+            path = self._format_path(content_hash)
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Removes the least recently used files, other than keep, until the
+        cache fits in max_size."""
+        try:
+            entries = [e for e in os.scandir(self.directory)
+                       if e.is_file() and not e.name.endswith('.tmp')]
+        except FileNotFoundError:
+            return
+        stats = sorted(((e.stat(), e.path) for e in entries),
+                       key=lambda x: x[0].st_mtime)
+        total = sum(s.st_size for s, path in stats)
+        for s, path in stats:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= s.st_size
+            log.debug('Removed {} from the import file cache'.format(path))
+
+    def _format_path(self, content_hash):
+        return os.path.join(self.directory, content_hash)
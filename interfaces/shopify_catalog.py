@@ -0,0 +1,213 @@
+import json, logging, time
+from datetime import datetime, timedelta, timezone
+
+from .redis_interface import RedisInterface
+
+
+log = logging.getLogger('development')
+
+# Only the fields the exports use are cached.
+PRODUCT_FIELDS = ('id', 'tags', 'product_type')
+VARIANT_FIELDS = ('id', 'product_id', 'inventory_item_id', 'barcode',
+                  'fulfillment_service')
+LEVEL_FIELDS = ('inventory_item_id', 'location_id', 'available')
+
+
+class ShopifyCatalogCache:
+    """Redis cache of a shop's products, variants, and inventory levels.
+
+    Records are stored as compact JSON in a hash per resource, keyed by id.
+    Each group of hashes has a meta hash with the time of the last refresh,
+    which is passed to Shopify as updated_at_min so only the records that
+    changed since are fetched. A group expires ttl after its last full
+    refresh, every write gives the written hashes the same expiry as the
+    meta hash. Deleted products don't show up as updated, so every
+    reconcile_interval the ids of all the products are fetched and the
+    cached products that are missing are dropped with their variants.
+
+    shopify:<shop>:catalog:products - product id to product
+    shopify:<shop>:catalog:variants - variant id to variant
+    shopify:<shop>:levels:<location_id>:levels - inventory item id to level
+    """
+
+    ttl = timedelta(hours=24)
+    reconcile_interval = timedelta(hours=1)
+    # Overlap between refreshes to allow for clock differences with Shopify.
+    clock_skew = timedelta(minutes=1)
+
+    def __init__(self, shop):
+        self.redis = RedisInterface('shopify')
+        self.redis.add_namespace(shop)
+
+    def load_catalog(self, fetch_products, fetch_product_ids):
+        """Returns the (products, variants) records refreshed from Shopify.
+
+        fetch_products(updated_at_min) yields the raw product dicts, with
+        their variants, updated since updated_at_min or all of them if None.
+        fetch_product_ids() yields the id of every product in the shop.
+        """
+        group = 'catalog'
+        refreshed_at = self._get_refreshed_at(group)
+        started = datetime.now(timezone.utc) - self.clock_skew
+        if refreshed_at is None:
+            products, variants = dict(), dict()
+        else:
+            products = self._get_records(group, 'products')
+            variants = self._get_records(group, 'variants')
+
+        variant_ids_by_product = dict()
+        for v in variants.values():
+            variant_ids_by_product.setdefault(v['product_id'], set()).add(v['id'])
+
+        updated_products = dict()
+        updated_variants = dict()
+        deleted_variants = set()
+        for p in fetch_products(refreshed_at):
+            updated_products[p['id']] = _compact(p, PRODUCT_FIELDS)
+            product_variants = {v['id']: _compact(v, VARIANT_FIELDS)
+                                for v in p.get('variants', [])}
+            updated_variants.update(product_variants)
+            deleted_variants |= (variant_ids_by_product.get(p['id'], set())
+                                 - set(product_variants))
+
+        products.update(updated_products)
+        deleted_products = set()
+        reconciled = refreshed_at is None
+        if not reconciled and self._needs_reconcile(group):
+            deleted_products = set(products) - set(fetch_product_ids())
+            for id in deleted_products:
+                products.pop(id)
+                deleted_variants |= variant_ids_by_product.get(id, set())
+            reconciled = True
+
+        variants.update(updated_variants)
+        for id in deleted_variants:
+            variants.pop(id, None)
+
+        self._save(group, started, full=refreshed_at is None,
+                   records={'products': updated_products,
+                            'variants': updated_variants},
+                   deleted={'products': deleted_products,
+                            'variants': deleted_variants},
+                   reconciled=reconciled)
+        log.debug('Catalog cache refreshed, {} products updated, {} deleted'
+                  .format(len(updated_products), len(deleted_products)))
+        return products, variants
+
+    def load_levels(self, location_id, fetch_levels):
+        """Returns the inventory level records of a location keyed by
+        inventory item id, refreshed from Shopify.
+
+        fetch_levels(updated_at_min) yields the raw level dicts.
+        """
+        group = self._levels_group(location_id)
+        refreshed_at = self._get_refreshed_at(group)
+        started = datetime.now(timezone.utc) - self.clock_skew
+        if refreshed_at is None:
+            levels = dict()
+        else:
+            levels = self._get_records(group, 'levels')
+
+        updated_levels = {
+            l['inventory_item_id']: _compact(l, LEVEL_FIELDS)
+            for l in fetch_levels(refreshed_at)}
+        levels.update(updated_levels)
+
+        self._save(group, started, full=refreshed_at is None,
+                   records={'levels': updated_levels})
+        return levels
+
+    def update_product(self, product):
+        """Writes a product changed by this app through to the cache."""
+        self._update_records('catalog', 'products',
+                             [_compact(product, PRODUCT_FIELDS)], 'id')
+
+    def update_levels(self, location_id, levels):
+        """Writes levels changed by this app through to the cache."""
+        self._update_records(self._levels_group(location_id), 'levels',
+                             [_compact(l, LEVEL_FIELDS) for l in levels],
+                             'inventory_item_id')
+
+    def invalidate(self):
+        """Deletes all of the cached records for the shop."""
+        keys = list(self.redis.client.scan_iter(
+            match=self.redis.format_key('*')))
+        if keys:
+            self.redis.client.delete(*keys)
+
+    # Private Methods #########################################################
+
+    def _levels_group(self, location_id):
+        return 'levels:{}'.format(location_id)
+
+    def _get_refreshed_at(self, group):
+        value = self.redis.client.hget(
+            self.redis.format_key(group, 'meta'), 'refreshed_at')
+        if value is None:
+            return None
+        return value.decode('utf-8')
+
+    def _get_ttl(self, group):
+        """Returns the time left until a group expires, or None if it isn't
+        cached or has no expiry."""
+        ms = self.redis.client.pttl(self.redis.format_key(group, 'meta'))
+        if ms is None or ms < 0:
+            return None
+        return timedelta(milliseconds=ms)
+
+    def _needs_reconcile(self, group):
+        value = self.redis.client.hget(
+            self.redis.format_key(group, 'meta'), 'reconciled_at')
+        if value is None:
+            return True
+        return (time.time() - float(value)
+                > self.reconcile_interval.total_seconds())
+
+    def _get_records(self, group, name):
+        return {
+            int(k): json.loads(v.decode('utf-8'))
+            for k, v in self.redis.client.hgetall(
+                self.redis.format_key(group, name)).items()}
+
+    def _save(self, group, refreshed_at, full, records, deleted=None,
+              reconciled=False):
+        # The group still expires ttl after the last full refresh.
+        ttl = None if full else self._get_ttl(group)
+        pipe = self.redis.client.pipeline()
+        keys = [self.redis.format_key(group, name) for name in records]
+        meta_key = self.redis.format_key(group, 'meta')
+        if full:
+            pipe.delete(meta_key, *keys)
+        for name, items in records.items():
+            if items:
+                pipe.hmset(self.redis.format_key(group, name), {
+                    k: json.dumps(v) for k, v in items.items()})
+        for name, ids in (deleted or {}).items():
+            if ids:
+                pipe.hdel(self.redis.format_key(group, name), *ids)
+        pipe.hset(meta_key, 'refreshed_at', refreshed_at.isoformat())
+        if reconciled:
+            pipe.hset(meta_key, 'reconciled_at', refreshed_at.timestamp())
+        # Hashes created since the full refresh get the expiry as well.
+        for key in keys + [meta_key]:
+            pipe.pexpire(key, ttl or self.ttl)
+        pipe.execute()
+
+    def _update_records(self, group, name, records, id_field):
+        # Only update groups that are cached, a missing group is fetched in
+        # full the next time it is loaded.
+        ttl = self._get_ttl(group)
+        if ttl is None or not records:
+            return
+        key = self.redis.format_key(group, name)
+        pipe = self.redis.client.pipeline()
+        pipe.hmset(key, {r[id_field]: json.dumps(r) for r in records})
+        pipe.pexpire(key, ttl)
+        pipe.execute()
+
+
+def _compact(item, fields):
+    """Returns a dict of fields from a dict or Shopify resource."""
+    if not isinstance(item, dict):
+        item = item.attributes
+    return {f: item.get(f) for f in fields}
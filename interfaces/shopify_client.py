@@ -0,0 +1,176 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote
+
+import requests
+from django.conf import settings
+
+from .shopify_throttle import ShopifyRateLimiter
+
+
+log = logging.getLogger('development')
+
+
+class ShopifyGraphQLError(Exception):
+    """Raised when Shopify returns top level errors for a GraphQL request."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(
+            e.get('message', str(e)) for e in errors))
+
+
+class ShopifyClient:
+    """HTTP client for the Admin API of a single shop.
+
+    Takes the same private app shop_url as ShopifyInterface:
+    https://{api_key}:{password}@{shop_name}.myshopify.com/admin
+
+    Each client has its own session and credentials, so clients for
+    different shops can be used at the same time from different threads.
+    Requests use the Admin API version in the SHOPIFY_API_VERSION setting.
+    """
+
+    def __init__(self, shop_url):
+        parts = urlparse(shop_url)
+        if not (parts.scheme and parts.hostname):
+            raise ValueError('Invalid shop url: {}'.format(shop_url))
+        self.api_key = unquote(parts.username or '')
+        self.password = unquote(parts.password or '')
+        host = parts.hostname
+        if parts.port:
+            host = '{}:{}'.format(host, parts.port)
+        self.host = host
+        self.api_version = settings.SHOPIFY_API_VERSION
+        self.base_url = '{}://{}/admin/api/{}/'.format(
+            parts.scheme, host, self.api_version)
+        self.limiter = ShopifyRateLimiter.for_shop(host)
+        # Estimated cost of the next GraphQL request, updated from the cost
+        # Shopify reports for each one.
+        self._graphql_cost = 10
+
+        self.session = self.new_session()
+
+    def new_session(self):
+        """Returns a requests session with the shop's credentials."""
+        session = requests.Session()
+        session.auth = (self.api_key, self.password)
+        session.headers['X-Shopify-Access-Token'] = self.password
+        return session
+
+    def request(self, method, path, session=None, **kwargs):
+        """Sends a REST request and returns the response.
+
+        path is relative to the versioned Admin API url, like 'products.json',
+        or a full url. Requests are paced by the shop's rate limiter and
+        retried when Shopify throttles them. They are sent with the client's
+        session unless another one is passed, sessions aren't thread safe.
+        """
+        session = session or self.session
+        if '://' in path:
+            url = path
+        else:
+            url = self.base_url + path
+        bucket = self.limiter.rest
+        attempt = 0
+        while True:
+            bucket.acquire()
+            response = session.request(method, url, **kwargs)
+            if response.status_code == 429:
+                self.limiter.backoff(bucket, attempt,
+                                     response.headers.get('Retry-After'))
+                attempt += 1
+                continue
+            response.raise_for_status()
+            self.limiter.update_rest(
+                response.headers.get('X-Shopify-Shop-Api-Call-Limit'))
+            return response
+
+    def iter_pages(self, resource, limit=250, prefetch=True, **params):
+        """Yields each page of a REST resource list as a list of dicts.
+
+        Pages are followed with the page_info cursor in the Link header, so
+        there is no extra request for an empty last page. With prefetch the
+        next page is requested while the current one is being processed, on
+        a thread with its own session.
+        """
+        path = '{}.json'.format(resource)
+        if prefetch:
+            executor = ThreadPoolExecutor(max_workers=1)
+            prefetch_session = self.new_session()
+        else:
+            executor = None
+        try:
+            response = self.request('GET', path,
+                                    params=dict(params, limit=limit))
+            while response is not None:
+                # The next page url only carries the limit and page_info.
+                next_page = response.links.get('next', {}).get('url')
+                if next_page is None:
+                    pending = None
+                elif executor:
+                    pending = executor.submit(self.request, 'GET', next_page,
+                                              session=prefetch_session)
+                else:
+                    pending = next_page
+
+                yield response.json()[resource]
+
+                if pending is None:
+                    response = None
+                elif executor:
+                    response = pending.result()
+                else:
+                    response = self.request('GET', pending)
+        finally:
+            if executor:
+                # A pending request finishes before the session is closed.
+                executor.submit(prefetch_session.close)
+                executor.shutdown(wait=False)
+
+    def graphql(self, query, variables=None):
+        """Runs a GraphQL query or mutation and returns its data.
+
+        Requests are paced by the shop's rate limiter and retried when
+        Shopify throttles them.
+        """
+        bucket = self.limiter.graphql
+        attempt = 0
+        while True:
+            bucket.acquire(self._graphql_cost)
+            response = self.session.post(
+                self.base_url + 'graphql.json',
+                json={'query': query, 'variables': variables or {}})
+            if response.status_code == 429:
+                self.limiter.backoff(bucket, attempt,
+                                     response.headers.get('Retry-After'))
+                attempt += 1
+                continue
+            response.raise_for_status()
+
+            result = response.json()
+            cost = self.limiter.update_graphql(result.get('extensions'))
+            if cost:
+                self._graphql_cost = cost
+            if _is_throttled(result):
+                self.limiter.backoff(bucket, attempt)
+                attempt += 1
+                continue
+            if result.get('errors'):
+                raise ShopifyGraphQLError(result['errors'])
+            return result['data']
+
+
+def to_gid(resource, id):
+    """Returns the GraphQL global id for a REST resource id."""
+    return 'gid://shopify/{}/{}'.format(resource, id)
+
+def from_gid(gid):
+    """Returns the REST resource id from a GraphQL global id."""
+    return int(gid.rsplit('/', 1)[-1])
+
+def _is_throttled(result):
+    for e in result.get('errors') or []:
+        if (e.get('extensions') or {}).get('code') == 'THROTTLED':
+            return True
+    return False
@@ -1,24 +1,60 @@
 import logging, shopify
+from collections import namedtuple
 from pprint import pprint, pformat
 
+import requests
+
+from .shopify_catalog import ShopifyCatalogCache
+from .shopify_client import ShopifyClient, to_gid
+
 
 log = logging.getLogger('development')
 
+# Result of updating an inventory level in a batch. error is None on success.
+LevelUpdate = namedtuple('LevelUpdate',
+                         ['inventory_item_id', 'available', 'error'])
+
+SET_QUANTITIES_MUTATION = '''
+mutation setAvailable($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    userErrors {
+      code
+      field
+      message
+    }
+  }
+}
+'''
+
 
 class ShopifyInterface:
+    """Interface to a single shop.
+
+    All requests go through the instance's own ShopifyClient rather than the
+    process wide site of the shopify library, so interfaces for different
+    shops can be used concurrently. The shopify resource classes are only
+    used to wrap the returned data.
+    """
 
-    def __init__(self, shop_url, fulfillment_service_id=None):
+    def __init__(self, shop_url, fulfillment_service_id=None, use_cache=True):
         """setup connection to Shopify"""
         log.debug('Init ShopifyInterface')
 
         # Setup API client
         self.shop_url = shop_url
-        shopify.ShopifyResource.set_site(self.shop_url)
+        self.client = ShopifyClient(self.shop_url)
+        # Products, variants, and inventory levels are cached in Redis and
+        # shared between the exports for this shop.
+        if use_cache:
+            self.cache = ShopifyCatalogCache(self.client.host)
+        else:
+            self.cache = None
 
         # test to ensure shop_url is valid
         try:
             # Returns the Shop data. Simple and quick way to test.
-            self.shop = shopify.Shop.current()
+            self.shop = _build(shopify.Shop,
+                self.client.request('GET', 'shop.json').json()['shop'])
         except Exception as e:
             raise
         else:
@@ -41,7 +77,7 @@ class ShopifyInterface:
     @property
     def products(self):
         if not self.__products:
-            self.__products = self._get_from_shopify(shopify.Product)
+            self._load_catalog()
         return self.__products
 
     @products.setter
@@ -51,11 +87,7 @@ class ShopifyInterface:
     @property
     def variants(self):
         if not self.__variants:
-            self.__variants = {
-                v.id:v
-                for v in self._get_all_paged(
-                        shopify.Variant.find)
-                if v.fulfillment_service == self.default_fulfillment.handle}
+            self._load_catalog()
         return self.__variants
 
     @variants.setter
@@ -79,28 +111,110 @@ class ShopifyInterface:
         if not self.default_fulfillment:
             raise ValueError('FulfillmentService needs to be set.')
         if not self.__inventory_levels:
-            self.__inventory_levels = {
-                x.inventory_item_id:x
-                for x in self._get_all_paged(
-                        shopify.InventoryLevel.find,
-                        location_ids=self.default_fulfillment.location_id)}
+            if self.cache is None:
+                self.__inventory_levels = {
+                    x.inventory_item_id:x
+                    for x in self.iter_inventory_levels()}
+            else:
+                levels = self.cache.load_levels(
+                    self.default_fulfillment.location_id, self._fetch_levels)
+                self.__inventory_levels = {
+                    key:_build(shopify.InventoryLevel, level)
+                    for key, level in levels.items()}
         return self.__inventory_levels
 
     @inventory_levels.setter
     def inventory_levels(self, value):
         self.__inventory_levels = value
 
+    def invalidate_cache(self):
+        """Clears the cached catalog so it is fetched from Shopify again."""
+        if self.cache is not None:
+            self.cache.invalidate()
+        self.products = False
+        self.variants = False
+        self.inventory_levels = False
+
+    def _load_catalog(self):
+        """Loads the products and the variants of the default fulfillment
+        service in a single pass over the products."""
+        if self.cache is None:
+            products = dict()
+            variants = dict()
+            for p in self._fetch_products():
+                products[p['id']] = p
+                for v in p.get('variants', []):
+                    variants[v['id']] = v
+        else:
+            products, variants = self.cache.load_catalog(
+                self._fetch_products, self._fetch_product_ids)
+
+        self.__products = {
+            id:_build(shopify.Product, p) for id, p in products.items()}
+        self.__variants = {
+            id:_build(shopify.Variant, v) for id, v in variants.items()
+            if v['fulfillment_service'] == self.default_fulfillment.handle}
+
+    def _fetch_products(self, updated_at_min=None):
+        params = dict()
+        if updated_at_min:
+            params['updated_at_min'] = updated_at_min
+        for page in self.client.iter_pages('products', **params):
+            yield from page
+
+    def _fetch_product_ids(self):
+        for page in self.client.iter_pages('products', fields='id'):
+            for p in page:
+                yield p['id']
+
+    def _fetch_levels(self, updated_at_min=None):
+        params = dict(location_ids=self.default_fulfillment.location_id)
+        if updated_at_min:
+            params['updated_at_min'] = updated_at_min
+        for page in self.client.iter_pages('inventory_levels', **params):
+            yield from page
+
+    # Streams #################################################################
+    # These yield the objects page by page as they are fetched from Shopify.
+
+    def iter_products(self, **params):
+        return self._iter_from_shopify(shopify.Product, **params)
+
+    def iter_variants(self, **params):
+        # Variants are listed with their products.
+        for page in self.client.iter_pages('products', **params):
+            for product in page:
+                for variant in product.get('variants', []):
+                    yield _build(shopify.Variant, variant)
+
+    def iter_inventory_levels(self, **params):
+        if not self.default_fulfillment:
+            raise ValueError('FulfillmentService needs to be set.')
+        return self._iter_from_shopify(
+            shopify.InventoryLevel,
+            location_ids=self.default_fulfillment.location_id,
+            **params)
+
     def reset_inventory(self):
         log.debug('Resetting Inventory')
-        for key, variant in self.variants.items():
-            self.set_level_available(variant, 0)
+        errors = [r for r in self.set_levels_available(
+                      (variant, 0) for variant in self.variants.values())
+                  if r.error]
+        for r in errors:
+            log.warning('Unable to reset inventory item {}: {}'.format(
+                r.inventory_item_id, r.error))
 
     def update_product(self, product, attr, value):
         # only update product if values don't match
         if getattr(product, attr) != value:
+            # Only the changed attribute is sent.
+            self.client.request(
+                'PUT', 'products/{}.json'.format(product.id),
+                json={'product': {'id': product.id, attr: value}})
             setattr(product, attr, value)
-            product.save()
             self.products[product.id] = product
+            if self.cache is not None:
+                self.cache.update_product(product)
 
     def get_level_available(self, variant):
         level = self.inventory_levels[variant.inventory_item_id]
@@ -122,7 +236,15 @@ class ShopifyInterface:
         if level.available == available:
             return level
 
-        new_level = shopify.InventoryLevel.set(
+        return self._connect_level(key, available)
+
+    def _connect_level(self, key, available):
+        """Sets a level with the REST API and returns the new level.
+
+        Unlike the GraphQL mutation this also works for items that aren't
+        stocked at the location yet, they are connected to it.
+        """
+        new_level = self._set_inventory_level(
             location_id=self.default_fulfillment.location_id,
             inventory_item_id=key,
             # We're using a fulfillment service so we can only have one
@@ -133,30 +255,143 @@ class ShopifyInterface:
 
         # save the updated level
         self.inventory_levels[key] = new_level
+        if self.cache is not None:
+            self.cache.update_levels(self.default_fulfillment.location_id,
+                                     [new_level])
         return new_level
 
-    def _set_inventory_level(self, level, available):
-        shopify.InventoryLevel.set(
-            location_id=level.location_id,
-            inventory_item_id=level.inventory_item_id,
-            available=available)
+    def set_levels_available(self, updates, batch_size=250):
+        """Sets the available quantity of many variants in batches.
+
+        updates is an iterable of (variant, available) pairs. Levels that
+        already match are skipped, the rest are sent as a single GraphQL
+        mutation per batch_size items. Items that aren't stocked at the
+        location are set one at a time with the REST API, which connects
+        them. Returns a list of LevelUpdate results, one for each level that
+        was sent.
+        """
+        results = []
+        batch = []
+        for variant, available in updates:
+            key = variant.inventory_item_id
+            try:
+                level = self.inventory_levels[key]
+            except KeyError:
+                # There is no level until the item is stocked at the location.
+                results.append(self._connect_level_result(key, available))
+                continue
+
+            # Only update if the available amounts are different.
+            if level.available == available:
+                continue
+
+            batch.append((key, available))
+            if len(batch) >= batch_size:
+                results.extend(self._set_levels_batch(batch))
+                batch = []
+
+        if batch:
+            results.extend(self._set_levels_batch(batch))
+        return results
+
+    def _set_levels_batch(self, batch):
+        errors = self._send_levels(batch)
+        if None in errors:
+            # The error is not specific to one item so the whole batch failed.
+            return [LevelUpdate(key, available, errors[None])
+                    for key, available in batch]
+
+        if errors:
+            # The mutation is applied all or nothing. The items with errors,
+            # like the ones that aren't stocked at the location, are set with
+            # the REST API and the others are sent again on their own.
+            results = [self._connect_level_result(key, available)
+                       for index, (key, available) in enumerate(batch)
+                       if index in errors]
+            retry = [item for index, item in enumerate(batch)
+                     if index not in errors]
+            if retry:
+                results.extend(self._set_levels_batch(retry))
+            return results
+
+        results = []
+        for key, available in batch:
+            # save the updated level
+            self.inventory_levels[key].available = available
+            results.append(LevelUpdate(key, available, None))
+        if self.cache is not None:
+            self.cache.update_levels(
+                self.default_fulfillment.location_id,
+                [self.inventory_levels[key] for key, available in batch])
+        return results
+
+    def _connect_level_result(self, key, available):
+        # A failed level is recorded so the results of the other levels
+        # aren't lost.
+        try:
+            self._connect_level(key, available)
+        except requests.RequestException as e:
+            return LevelUpdate(key, available, str(e))
+        except (KeyError, ValueError) as e:
+            return LevelUpdate(
+                key, available,
+                'Invalid inventory level response: {}'.format(e))
+        return LevelUpdate(key, available, None)
+
+    def _send_levels(self, batch):
+        """Sends a batch of levels and returns the errors by batch index.
+
+        Errors that don't belong to a single item are keyed by None.
+        """
+        location_id = self.default_fulfillment.location_id
+        data = self.client.graphql(SET_QUANTITIES_MUTATION, {
+            'input': {
+                'name': 'available',
+                'reason': 'correction',
+                # The levels are set to the exported quantities regardless of
+                # what they are in Shopify.
+                'ignoreCompareQuantity': True,
+                'quantities': [{
+                    'inventoryItemId': to_gid('InventoryItem', key),
+                    'locationId': to_gid('Location', location_id),
+                    'quantity': available,
+                } for key, available in batch],
+            }})
+
+        # The userErrors field path is ['input', 'quantities', index, ...]
+        errors = dict()
+        for e in data['inventorySetQuantities']['userErrors']:
+            field = e.get('field') or []
+            try:
+                index = int(field[2])
+            except (IndexError, TypeError, ValueError):
+                index = None
+            if index is not None and not 0 <= index < len(batch):
+                index = None
+            errors.setdefault(index, e['message'])
+        return errors
+
+    def _set_inventory_level(self, **data):
+        response = self.client.request('POST', 'inventory_levels/set.json',
+                                       json=data)
+        return _build(shopify.InventoryLevel,
+                      response.json()['inventory_level'])
     
     def _get_from_shopify(self, shopify_class, **kwargs):
         return {
             x.id:x
-            for x in self._get_all_paged(
-                    shopify_class.find, **kwargs)}
-
-    def _get_all_paged(self, page_cb, limit=250, page_numb=1, **kwargs):
-        items = []
-        has_more = True
-        while has_more:
-            page = page_cb(
-                limit=limit,
-                page=page_numb,
-                **kwargs
-            )
-            has_more = len(page) == limit
-            page_numb += 1
-            items.extend(page)
-        return items
+            for x in self._iter_from_shopify(shopify_class, **kwargs)}
+
+    def _iter_from_shopify(self, shopify_class, **params):
+        for page in self.client.iter_pages(shopify_class.plural, **params):
+            for attributes in page:
+                yield _build(shopify_class, attributes)
+
+
+def _build(shopify_class, attributes):
+    """Returns a resource for attributes returned by the API.
+
+    Like find(), the parent ids such as a variant's product_id are kept as
+    attributes instead of being moved to the prefix options.
+    """
+    return shopify_class(attributes, prefix_options={})
@@ -0,0 +1,135 @@
+import logging, threading, time
+
+
+log = logging.getLogger('development')
+
+
+class ShopifyThrottledError(Exception):
+    """Raised when a request is still throttled after all of its retries."""
+    pass
+
+
+class LeakyBucket:
+    """Model of one of Shopify's leaky bucket rate limits.
+
+    Every request adds its cost to the bucket and the bucket leaks at
+    leak_rate per second. acquire() blocks until the request fits in the
+    bucket without going over size - margin. The model is corrected with the
+    actual usage that Shopify reports in each response.
+    """
+
+    def __init__(self, size, leak_rate, margin):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.margin = margin
+        self.level = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        """Waits until there is room for the request then reserves it."""
+        with self._lock:
+            self._leak()
+            wait = (self.level + cost - (self.size - self.margin)) \
+                / self.leak_rate
+            # Reserve the cost now so concurrent requests queue behind it.
+            self.level += cost
+        if wait > 0:
+            log.debug('Throttling Shopify request for {:.2f}s'.format(wait))
+            time.sleep(wait)
+        return max(wait, 0)
+
+    def update(self, level, size=None, leak_rate=None):
+        """Sets the bucket to the usage reported by Shopify."""
+        with self._lock:
+            self._updated = time.monotonic()
+            self.level = level
+            if size:
+                self.size = size
+            if leak_rate:
+                self.leak_rate = leak_rate
+
+    def fill(self):
+        """Marks the bucket as at its limit after Shopify throttled a request.
+        """
+        self.update(self.size - self.margin)
+
+    def _leak(self):
+        now = time.monotonic()
+        self.level = max(0, self.level - (now - self._updated) * self.leak_rate)
+        self._updated = now
+
+
+class ShopifyRateLimiter:
+    """Paces the requests to a shop to run just under its API limits.
+
+    One limiter is shared by every client of the same shop in the process.
+    The REST bucket is updated from the X-Shopify-Shop-Api-Call-Limit header
+    and the GraphQL bucket from the cost extension of each response.
+    """
+
+    # Shopify's default limits for a standard plan.
+    rest_bucket_size = 40
+    rest_leak_rate = 2
+    graphql_bucket_size = 1000
+    graphql_restore_rate = 50
+
+    max_retries = 5
+    # Longest wait between retries when Shopify doesn't send Retry-After.
+    max_backoff = 30
+
+    _limiters = dict()
+    _limiters_lock = threading.Lock()
+
+    def __init__(self):
+        self.rest = LeakyBucket(self.rest_bucket_size, self.rest_leak_rate,
+                                margin=2)
+        self.graphql = LeakyBucket(self.graphql_bucket_size,
+                                   self.graphql_restore_rate, margin=50)
+
+    @classmethod
+    def for_shop(cls, shop):
+        """Returns the limiter for shop, creating it on first use."""
+        with cls._limiters_lock:
+            if shop not in cls._limiters:
+                cls._limiters[shop] = cls()
+            return cls._limiters[shop]
+
+    def update_rest(self, call_limit):
+        """Updates the REST bucket from an X-Shopify-Shop-Api-Call-Limit value
+        like '32/40'."""
+        try:
+            used, size = (int(x) for x in call_limit.split('/'))
+        except (AttributeError, ValueError):
+            return
+        self.rest.update(used, size)
+
+    def update_graphql(self, extensions):
+        """Updates the GraphQL bucket from the cost extension of a response.
+
+        Returns the requested cost of the query.
+        """
+        try:
+            cost = extensions['cost']
+            status = cost['throttleStatus']
+            self.graphql.update(
+                status['maximumAvailable'] - status['currentlyAvailable'],
+                status['maximumAvailable'],
+                status['restoreRate'])
+            return cost['requestedQueryCost']
+        except (KeyError, TypeError):
+            return None
+
+    def backoff(self, bucket, attempt, retry_after=None):
+        """Waits before retrying a throttled request."""
+        if attempt >= self.max_retries:
+            raise ShopifyThrottledError(
+                'Shopify request throttled {} times.'.format(attempt + 1))
+        try:
+            wait = float(retry_after)
+        except (TypeError, ValueError):
+            wait = min(2 ** attempt, self.max_backoff)
+        log.warning('Shopify request throttled, retrying in {}s'.format(wait))
+        time.sleep(wait)
+        # The retry is then paced by the bucket.
+        bucket.fill()
@@ -1,10 +1,20 @@
-import logging, os, inspect
+import hashlib, logging, os, inspect, json, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from pprint import pprint, pformat
+from socketserver import ThreadingMixIn
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
 
-import shopify
-from django.test import TestCase
+import dropbox, requests, shopify
+from django.test import TestCase, SimpleTestCase, override_settings
 
+from .file_cache import (
+    FileCache, DropboxContentHasher, DROPBOX_HASH_BLOCK_SIZE)
+from .shopify_client import ShopifyClient, from_gid
 from .shopify_interface import ShopifyInterface
+from .shopify_throttle import LeakyBucket, ShopifyRateLimiter
 from .dropbox_interface import DropboxInterface
 from .redis_interface import RedisInterface
 
@@ -196,9 +206,849 @@ class ShopifyInterfaceTest(TestCase):
         # Delete the fulfillment service
 
 
+class FakeShopServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeShopHandler(BaseHTTPRequestHandler):
+    """Serves the Admin API requests for a FakeShop."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        shop = self.server.shop
+        url = urlparse(self.path)
+        shop.requests.append(('GET', url.path))
+        if shop.throttle():
+            return self._send({'errors': 'Exceeded 2 calls per second'},
+                              status=429)
+        resource = url.path.rsplit('/', 1)[-1].replace('.json', '')
+        params = parse_qs(url.query)
+
+        if resource == 'shop':
+            return self._send({'shop': {'id': 1, 'name': shop.name}})
+        try:
+            items = shop.resources(resource, params)
+        except KeyError:
+            return self._send({'errors': 'Not Found'}, status=404)
+
+        # Cursor pagination, the page_info cursor is just the offset here.
+        limit = int(params.get('limit', ['50'])[0])
+        offset = int(params.get('page_info', ['0'])[0])
+        headers = dict()
+        if offset + limit < len(items):
+            headers['Link'] = '<http://{}:{}{}?limit={}&page_info={}>; rel="next"'.format(
+                *self.server.server_address, url.path, limit, offset + limit)
+        self._send({resource: items[offset:offset + limit]}, headers=headers)
+
+    def do_POST(self):
+        shop = self.server.shop
+        url = urlparse(self.path)
+        shop.requests.append(('POST', url.path))
+        if shop.throttle():
+            return self._send({'errors': 'Throttled'}, status=429)
+        body = self._read_body()
+
+        if self.headers.get('X-Shopify-Access-Token') != shop.password:
+            return self._send({'errors': 'Invalid API key'}, status=401)
+        if url.path.endswith('/graphql.json'):
+            return self._send(shop.set_quantities(body['variables']['input']))
+        if url.path.endswith('/inventory_levels/set.json'):
+            key = body['inventory_item_id']
+            if key in shop.unstocked:
+                if not body.get('disconnect_if_necessary'):
+                    return self._send({'errors': [
+                        'Inventory item is not stocked at the location.']},
+                        status=422)
+                shop.unstocked.discard(key)
+            shop.set_level(key, body['available'])
+            return self._send({'inventory_level': {
+                'inventory_item_id': key,
+                'location_id': body['location_id'],
+                'available': body['available']}})
+        self._send({'errors': 'Not Found'}, status=404)
+
+    def do_PUT(self):
+        shop = self.server.shop
+        url = urlparse(self.path)
+        shop.requests.append(('PUT', url.path))
+        body = self._read_body()
+
+        if self.headers.get('X-Shopify-Access-Token') != shop.password:
+            return self._send({'errors': 'Invalid API key'}, status=401)
+        product_id = int(url.path.rsplit('/', 1)[-1].replace('.json', ''))
+        attrs = dict(body['product'])
+        attrs.pop('id', None)
+        shop.update_product(product_id, **attrs)
+        self._send({'product': {'id': product_id}})
+
+    def _read_body(self):
+        return json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+
+    def _send(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Shopify-Shop-Api-Call-Limit',
+                         '{}/40'.format(self.server.shop.calls_made))
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeShop:
+    """A local stand-in for the Admin API of a shop.
+
+    Serves the shop, fulfillment services, products, variants, and inventory
+    levels and accepts inventorySetQuantities GraphQL mutations. Each request
+    is recorded in requests. The next throttled_requests requests get a 429
+    response. Products and levels can be filtered with updated_at_min.
+    """
+
+    service_id = 10
+    location_id = 20
+    service_handle = 'testing-fulfillment-service'
+    password = 'password'
+
+    def __init__(self, name='fake', numb_variants=10):
+        self.name = name
+        self.requests = []
+        self.throttled_requests = 0
+        self.calls_made = 1
+        # inventory item ids that are not stocked at the location
+        self.unstocked = set()
+        self.levels = dict()
+        self.level_updated_at = dict()
+        self.variants = []
+        for i in range(1, numb_variants + 1):
+            self.variants.append({
+                'id': 1000 + i,
+                'product_id': 100 + (i + 1) // 2,
+                'inventory_item_id': 2000 + i,
+                'barcode': str(638700000000 + i),
+                'fulfillment_service': self.service_handle,})
+            self.set_level(2000 + i, 0)
+        self.products = [
+            {'id': product_id, 'tags': '', 'product_type': 'Theia Shop',
+             'updated_at': self.now(),
+             'variants': [v for v in self.variants
+                          if v['product_id'] == product_id]}
+            for product_id in sorted({v['product_id'] for v in self.variants})]
+
+        self.server = FakeShopServer(('127.0.0.1', 0), FakeShopHandler)
+        self.server.shop = self
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://key:{}@127.0.0.1:{}/admin'.format(
+            self.password, self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def now(self):
+        return datetime.now(timezone.utc).isoformat()
+
+    def set_level(self, key, available):
+        self.levels[key] = available
+        self.level_updated_at[key] = self.now()
+
+    def update_product(self, product_id, **attrs):
+        product = next(p for p in self.products if p['id'] == product_id)
+        product.update(attrs, updated_at=self.now())
+
+    def delete_product(self, product_id):
+        self.products = [p for p in self.products if p['id'] != product_id]
+        self.variants = [v for v in self.variants
+                         if v['product_id'] != product_id]
+
+    def throttle(self):
+        if self.throttled_requests > 0:
+            self.throttled_requests -= 1
+            return True
+        return False
+
+    def graphql_requests(self):
+        return [r for r in self.requests if r[1].endswith('/graphql.json')]
+
+    def resources(self, resource, params):
+        if resource == 'fulfillment_services':
+            return [{'id': self.service_id,
+                     'location_id': self.location_id,
+                     'handle': self.service_handle,
+                     'name': 'Testing Fulfillment Service'}]
+        updated_at_min = params.get('updated_at_min', [''])[0]
+        if resource == 'products':
+            products = [p for p in self.products
+                        if p['updated_at'] >= updated_at_min]
+            if 'fields' in params:
+                fields = params['fields'][0].split(',')
+                products = [{f: p[f] for f in fields} for p in products]
+            return products
+        if resource == 'inventory_levels':
+            return [{'inventory_item_id': key,
+                     'location_id': self.location_id,
+                     'available': available,
+                     'updated_at': self.level_updated_at[key]}
+                    for key, available in sorted(self.levels.items())
+                    if self.level_updated_at[key] >= updated_at_min]
+        raise KeyError(resource)
+
+    def set_quantities(self, input):
+        errors = []
+        for index, q in enumerate(input['quantities']):
+            key = from_gid(q['inventoryItemId'])
+            if key not in self.levels or key in self.unstocked:
+                errors.append({
+                    'code': 'ITEM_NOT_STOCKED_AT_LOCATION',
+                    'field': ['input', 'quantities', str(index),
+                              'inventoryItemId'],
+                    'message': 'The item is not stocked at the location.'})
+        # All or nothing like Shopify.
+        if not errors:
+            for q in input['quantities']:
+                self.set_level(from_gid(q['inventoryItemId']), q['quantity'])
+        return {
+            'data': {'inventorySetQuantities': {'userErrors': errors}},
+            'extensions': {'cost': {
+                'requestedQueryCost': 10,
+                'actualQueryCost': 10,
+                'throttleStatus': {
+                    'maximumAvailable': 1000.0,
+                    'currentlyAvailable': 990,
+                    'restoreRate': 50.0}}}}
+
+
+class FakeShopTestCase(SimpleTestCase):
+    """Runs each test with a FakeShop of numb_variants variants and a
+    ShopifyInterface for it in shop."""
+
+    numb_variants = 10
+
+    def setUp(self):
+        self.fake = FakeShop(numb_variants=self.numb_variants)
+        self.shop = self.new_interface()
+        # The port of an earlier fake shop may be reused.
+        self.shop.invalidate_cache()
+
+    def tearDown(self):
+        self.shop.invalidate_cache()
+        self.fake.stop()
+
+    def new_interface(self):
+        return ShopifyInterface(
+            shop_url=self.fake.url,
+            fulfillment_service_id=FakeShop.service_id)
+
+
+class ShopifyInterfaceBatchTest(FakeShopTestCase):
+
+    numb_variants = 5
+
+    def rest_level_requests(self):
+        return [r for r in self.fake.requests
+                if r[1].endswith('/inventory_levels/set.json')]
+
+    def test_set_levels_available(self):
+        variants = sorted(self.shop.variants.values(), key=lambda v: v.id)
+        unstocked = variants[1].inventory_item_id
+        self.fake.unstocked.add(unstocked)
+        # An item without a level at the location.
+        missing = variants[4].inventory_item_id
+        del self.fake.levels[missing]
+
+        results = self.shop.set_levels_available(
+            [(v, 7) for v in variants], batch_size=2)
+
+        self.assertEqual(len(results), 5)
+        self.assertEqual([r for r in results if r.error], [])
+        for v in variants:
+            self.assertEqual(self.fake.levels[v.inventory_item_id], 7)
+            self.assertEqual(self.shop.get_level_available(v), 7)
+        self.assertNotIn(unstocked, self.fake.unstocked)
+        # Two batches, the first is sent again without the unstocked item,
+        # which is connected with the REST API like the missing one.
+        self.assertEqual(len(self.fake.graphql_requests()), 3)
+        self.assertEqual(len(self.rest_level_requests()), 2)
+
+        # Levels that already match are not sent.
+        results = self.shop.set_levels_available([(v, 7) for v in variants])
+        self.assertEqual(results, [])
+
+    def test_connect_level_errors(self):
+        variants = sorted(self.shop.variants.values(), key=lambda v: v.id)
+        for v in variants[:3]:
+            del self.fake.levels[v.inventory_item_id]
+        errors = [requests.ConnectionError('Connection refused'),
+                  requests.Timeout('Read timed out'),
+                  KeyError('inventory_level')]
+
+        with mock.patch.object(self.shop, '_set_inventory_level',
+                               side_effect=errors):
+            results = self.shop.set_levels_available(
+                [(v, 7) for v in variants[:4]])
+
+        # Each failure is recorded and the other levels are still sent.
+        self.assertEqual([r.error for r in results], [
+            'Connection refused', 'Read timed out',
+            "Invalid inventory level response: 'inventory_level'", None])
+        self.assertEqual(self.fake.levels[variants[3].inventory_item_id], 7)
+
+    def test_reset_inventory(self):
+        for key in list(self.fake.levels):
+            self.fake.set_level(key, 3)
+        self.shop.inventory_levels = None
+        self.shop.reset_inventory()
+        self.assertEqual(set(self.fake.levels.values()), {0})
+        self.assertEqual(len(self.fake.graphql_requests()), 1)
+
+
+class ShopifyPaginationTest(FakeShopTestCase):
+
+    # Four products with two variants each.
+    numb_variants = 8
+
+    def product_requests(self):
+        return [r for r in self.fake.requests
+                if r[1].endswith('/products.json')]
+
+    def test_iter_pages(self):
+        for prefetch in (True, False):
+            self.fake.requests = []
+            pages = list(self.shop.client.iter_pages(
+                'products', limit=2, prefetch=prefetch))
+            self.assertEqual([len(p) for p in pages], [2, 2])
+            # No extra request for an empty page after an exact multiple.
+            self.assertEqual(len(self.product_requests()), 2)
+
+    def test_prefetch_session(self):
+        client = self.shop.client
+        with mock.patch.object(client.session, 'request',
+                               wraps=client.session.request) as request:
+            pages = list(client.iter_pages('products', limit=2))
+        self.assertEqual(len(pages), 2)
+        # The next page is prefetched with another session.
+        self.assertEqual(request.call_count, 1)
+
+    def test_streams(self):
+        variants = list(self.shop.iter_variants(limit=3))
+        self.assertEqual(len(variants), 8)
+        self.assertIsInstance(variants[0], shopify.Variant)
+        self.assertEqual(variants[0].barcode, '638700000001')
+        self.assertEqual(variants[0].product_id, 101)
+
+        levels = list(self.shop.iter_inventory_levels(limit=5))
+        self.assertEqual(len(levels), 8)
+        self.assertEqual(levels[0].location_id, FakeShop.location_id)
+
+    @override_settings(SHOPIFY_API_VERSION='2025-01')
+    def test_api_version(self):
+        client = ShopifyClient(self.fake.url)
+        self.assertTrue(client.base_url.endswith('/admin/api/2025-01/'))
+        client.request('GET', 'shop.json')
+        self.assertEqual(self.fake.requests[-1][1],
+                         '/admin/api/2025-01/shop.json')
+
+    def test_stream_stops_early(self):
+        products = self.shop.iter_products(limit=1, prefetch=False)
+        self.assertEqual(next(products).id, 101)
+        products.close()
+        self.assertEqual(len(self.product_requests()), 1)
+
+
+class ShopifyThrottleTest(FakeShopTestCase):
+
+    numb_variants = 2
+
+    def setUp(self):
+        super().setUp()
+        self.fake.calls_made = 30
+
+    def test_leaky_bucket(self):
+        bucket = LeakyBucket(size=10, leak_rate=100, margin=0)
+        self.assertEqual(bucket.acquire(10), 0)
+        # Over the limit so it waits for 5 calls to leak out.
+        self.assertAlmostEqual(bucket.acquire(5), 0.05, places=2)
+
+    def test_rest_call_limit(self):
+        limiter = ShopifyRateLimiter.for_shop(self.shop.client.host)
+        self.assertIs(limiter, self.shop.client.limiter)
+        self.shop.products
+        # Updated from the last response header.
+        self.assertAlmostEqual(limiter.rest.level, 30, delta=1)
+
+    def test_rest_retry(self):
+        self.fake.throttled_requests = 1
+        self.assertEqual(len(self.shop.products), 1)
+        product_requests = [r for r in self.fake.requests
+                            if r[1].endswith('/products.json')]
+        self.assertEqual(len(product_requests), 2)
+
+    def test_graphql_retry(self):
+        variant = next(iter(self.shop.variants.values()))
+        self.shop.inventory_levels
+        self.fake.throttled_requests = 2
+        results = self.shop.set_levels_available([(variant, 5)])
+        self.assertIsNone(results[0].error)
+        self.assertEqual(len(self.fake.graphql_requests()), 3)
+        # Updated from the cost extension of the last response.
+        self.assertAlmostEqual(self.shop.client.limiter.graphql.level, 10,
+                               delta=1)
+
+
+class ShopifyCatalogCacheTest(FakeShopTestCase):
+
+    # Three products with two variants each.
+    numb_variants = 6
+
+    def new_interface(self):
+        shop = super().new_interface()
+        # Only fetch the records changed after the last refresh.
+        shop.cache.clock_skew = timedelta(0)
+        return shop
+
+    def resource_requests(self, resource):
+        return [r for r in self.fake.requests
+                if r[1].endswith('/{}.json'.format(resource))]
+
+    def test_load_catalog(self):
+        self.assertEqual(len(self.shop.variants), 6)
+        self.assertEqual(len(self.shop.inventory_levels), 6)
+
+        # A new interface for the same shop reuses the cached catalog and
+        # only fetches what changed.
+        self.fake.update_product(101, product_type='Theia Collection')
+        self.fake.set_level(2003, 8)
+        self.fake.requests = []
+        shop = self.new_interface()
+        self.assertEqual(len(shop.variants), 6)
+        self.assertIsInstance(shop.variants[1001], shopify.Variant)
+        self.assertEqual(shop.variants[1001].barcode, '638700000001')
+        self.assertEqual(shop.products[101].product_type, 'Theia Collection')
+        self.assertEqual(shop.products[102].product_type, 'Theia Shop')
+        self.assertEqual(shop.inventory_levels[2003].available, 8)
+        self.assertEqual(shop.inventory_levels[2001].available, 0)
+        self.assertEqual(len(self.resource_requests('products')), 1)
+        self.assertEqual(len(self.resource_requests('inventory_levels')), 1)
+
+    def test_removed_variant(self):
+        self.shop.variants
+        product = self.fake.products[0]
+        self.fake.update_product(101, variants=product['variants'][:1])
+        shop = self.new_interface()
+        self.assertNotIn(1002, shop.variants)
+        self.assertIn(1001, shop.variants)
+
+    def test_deleted_product(self):
+        self.shop.variants
+        self.fake.delete_product(102)
+        # Deleted products are only found when the product ids are
+        # reconciled.
+        shop = self.new_interface()
+        self.assertIn(102, shop.products)
+
+        shop = self.new_interface()
+        shop.cache.reconcile_interval = timedelta(0)
+        self.assertNotIn(102, shop.products)
+        self.assertEqual(sorted(shop.variants), [1001, 1002, 1005, 1006])
+        # The deletion is saved in the cache.
+        shop = self.new_interface()
+        self.assertNotIn(102, shop.products)
+        self.assertNotIn(1003, shop.variants)
+
+    def test_write_through(self):
+        variants = sorted(self.shop.variants.values(), key=lambda v: v.id)
+        self.shop.set_levels_available([(v, 4) for v in variants])
+
+        # Nothing has changed in the shop since the levels were written.
+        self.fake.level_updated_at = {
+            key: '' for key in self.fake.level_updated_at}
+        shop = self.new_interface()
+        self.assertEqual(
+            {l.available for l in shop.inventory_levels.values()}, {4})
+
+    def test_expiry(self):
+        variants = sorted(self.shop.variants.values(), key=lambda v: v.id)
+        self.shop.inventory_levels
+        cache = self.shop.cache
+        client = cache.redis.client
+        group = 'levels:{}'.format(FakeShop.location_id)
+        levels_key = cache.redis.format_key(group, 'levels')
+        client.pexpire(cache.redis.format_key(group, 'meta'), 60000)
+
+        # Hashes created after the full refresh expire with their group.
+        client.delete(levels_key)
+        self.shop.set_levels_available([(variants[0], 4)])
+        self.assertTrue(0 < client.pttl(levels_key) <= 60000)
+
+        client.delete(levels_key)
+        self.fake.set_level(2003, 8)
+        self.new_interface().inventory_levels
+        self.assertTrue(0 < client.pttl(levels_key) <= 60000)
+
+    def test_invalidate_cache(self):
+        self.shop.variants
+        self.shop.invalidate_cache()
+        self.fake.requests = []
+        shop = self.new_interface()
+        shop.variants
+        self.assertEqual(len(self.resource_requests('products')), 1)
+        self.assertEqual(len(shop.products), 3)
+
+
+class ShopifyConcurrencyTest(SimpleTestCase):
+
+    def setUp(self):
+        self.fakes = [FakeShop('theia', numb_variants=4),
+                      FakeShop('other', numb_variants=6)]
+
+    def tearDown(self):
+        for fake in self.fakes:
+            fake.stop()
+
+    def export(self, fake, available):
+        shop = ShopifyInterface(
+            shop_url=fake.url,
+            fulfillment_service_id=FakeShop.service_id,
+            use_cache=False)
+        variants = sorted(shop.variants.values(), key=lambda v: v.id)
+        self.barrier.wait()
+        shop.set_levels_available([(v, available) for v in variants[1:]])
+        shop.set_level_available(variants[0], available + 1)
+        product = shop.products[fake.products[0]['id']]
+        shop.update_product(product, 'product_type', shop.shop.name)
+        return shop
+
+    def test_concurrent_exports(self):
+        site = shopify.ShopifyResource.site
+        # Start the writes together so the requests are interleaved.
+        self.barrier = threading.Barrier(len(self.fakes))
+        with ThreadPoolExecutor(max_workers=len(self.fakes)) as executor:
+            shops = list(executor.map(self.export, self.fakes, [5, 9]))
+
+        for shop, fake, available in zip(shops, self.fakes, [5, 9]):
+            self.assertEqual(shop.shop.name, fake.name)
+            self.assertEqual(len(shop.variants), len(fake.variants))
+            levels = sorted(fake.levels.items())
+            self.assertEqual(levels[0][1], available + 1)
+            self.assertEqual({a for k, a in levels[1:]}, {available})
+            self.assertEqual(fake.products[0]['product_type'], fake.name)
+            self.assertEqual(fake.products[1]['product_type'], 'Theia Shop')
+        # The global site of the shopify library is left alone.
+        self.assertEqual(shopify.ShopifyResource.site, site)
+
+
 class DropboxInterfaceTest(TestCase):
     pass
 
+
+def content_hash(data):
+    hasher = DropboxContentHasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+class FileCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = FileCache(self.directory.name, max_size=30)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_content_hash(self):
+        data = os.urandom(DROPBOX_HASH_BLOCK_SIZE + 10)
+        blocks = [data[:DROPBOX_HASH_BLOCK_SIZE], data[DROPBOX_HASH_BLOCK_SIZE:]]
+        expected = hashlib.sha256(b''.join(
+            hashlib.sha256(b).digest() for b in blocks)).hexdigest()
+        for size in (7, 1024 * 1024, len(data)):
+            hasher = DropboxContentHasher()
+            for i in range(0, len(data), size):
+                hasher.update(data[i:i + size])
+            self.assertEqual(hasher.hexdigest(), expected)
+
+    def test_put_get(self):
+        data = b'UPC,QUANTITY\r\n'
+        key = content_hash(data)
+        self.assertIsNone(self.cache.get(key))
+        path = self.cache.put(key, [data[:3], data[3:]])
+        self.assertEqual(self.cache.get(key), path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        with self.assertRaises(ValueError):
+            self.cache.put(content_hash(b'other'), [data])
+        self.assertEqual(os.listdir(self.directory.name), [key])
+
+    def test_tee(self):
+        data = b'UPC,QUANTITY\r\n'
+        key = content_hash(data)
+        chunks = self.cache.tee(key, [data[:3], data[3:]])
+        self.assertEqual(next(chunks), data[:3])
+        # The file is only added once all of the chunks are read.
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual(list(chunks), [data[3:]])
+        self.assertIsNotNone(self.cache.get(key))
+
+        # A partly read file isn't added.
+        other = b'other data'
+        chunks = self.cache.tee(content_hash(other), [other[:5], other[5:]])
+        next(chunks)
+        chunks.close()
+        self.assertEqual(os.listdir(self.directory.name), [key])
+
+    def test_download_chunks(self):
+        data = b'UPC,QUANTITY\r\n638700000001,3\r\n'
+        key = content_hash(data)
+        response = mock.Mock()
+        response.iter_content.return_value = [data[:10], data[10:]]
+        dropbox_interface = DropboxInterface()
+        dropbox_interface.file_cache = self.cache
+        self.cache.max_size = 1024
+        metadata = mock.Mock(content_hash=key)
+        with mock.patch.object(dropbox_interface, 'download_file',
+                               return_value=(metadata, response)) as download:
+            self.assertEqual(
+                b''.join(dropbox_interface.download_chunks('id', key)), data)
+            response.close.assert_called_once_with()
+            # The second time the file is read from the cache.
+            self.assertEqual(
+                b''.join(dropbox_interface.download_chunks('id', key)), data)
+        self.assertEqual(download.call_count, 1)
+
+    def test_evict(self):
+        keys = []
+        for i in range(3):
+            data = str(i).encode() * 10
+            keys.append(content_hash(data))
+            self.cache.put(keys[-1], [data])
+            # Make sure the files have distinct modification times.
+            os.utime(self.cache.get(keys[-1]), (i, i))
+        # The first file is used again so the second one is evicted.
+        self.cache.get(keys[0])
+        self.cache.put(content_hash(b'x'), [b'x'])
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
+
+
+class DropboxChangesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dropbox = DropboxInterface()
+        self.dropbox.redis_namespace = 'dropbox-testing'
+        self.runs = 0
+
+    def tearDown(self):
+        self.dropbox.redis_client.delete(
+            self.dropbox._format_changes_key(
+                self.dropbox.changes_pending_key_format))
+
+    def test_no_changes(self):
+        self.assertTrue(self.dropbox.process_changes(self.handler))
+        self.assertEqual(self.runs, 0)
+
+    def test_coalesce_changes(self):
+        for i in range(3):
+            self.dropbox.notify_changes()
+
+        def handler():
+            self.handler()
+            if self.runs == 1:
+                # A burst of notifications during the first run, their tasks
+                # return straight away.
+                for i in range(3):
+                    self.dropbox.notify_changes()
+                    self.assertFalse(
+                        self.dropbox.process_changes(self.handler))
+
+        self.assertTrue(self.dropbox.process_changes(handler))
+        # One follow up run for the notifications during the first run.
+        self.assertEqual(self.runs, 2)
+
+    def test_handler_error(self):
+        self.dropbox.notify_changes()
+
+        def handler():
+            self.handler()
+            raise RuntimeError('Unable to list the changes.')
+
+        with self.assertRaises(RuntimeError):
+            self.dropbox.process_changes(handler)
+        # The changes are still pending for the next run.
+        self.assertTrue(self.dropbox.process_changes(self.handler))
+        self.assertEqual(self.runs, 2)
+
+    def handler(self):
+        self.runs += 1
+
+
+class FakeDropboxAPI(requests.adapters.BaseAdapter):
+    """A local stand-in for the Dropbox longpoll endpoint.
+
+    Mounted on the requests session of a dropbox.Dropbox client, so the
+    requests and responses go through the SDK like they would with Dropbox.
+    Each poll returns the next of results, a list of (changes, backoff), and
+    stop is set once they have all been returned. 'reset' for changes
+    returns the error for a cursor that is no longer valid.
+    """
+
+    def __init__(self, results, stop):
+        super().__init__()
+        self.results = list(results)
+        self.stop = stop
+        self.cursors = []
+
+    def client(self):
+        session = requests.Session()
+        session.mount('https://', self)
+        return dropbox.Dropbox('token', session=session)
+
+    def send(self, request, **kwargs):
+        if not request.url.endswith('/2/files/list_folder/longpoll'):
+            return self._response(request, {'error': 'Not Found'}, 404)
+        self.cursors.append(json.loads(request.body)['cursor'])
+        changes, backoff = self.results.pop(0)
+        if not self.results:
+            self.stop.set()
+        if changes == 'reset':
+            return self._response(request, {
+                'error_summary': 'reset/',
+                'error': {'.tag': 'reset'}}, 409)
+        data = {'changes': changes}
+        if backoff:
+            data['backoff'] = backoff
+        return self._response(request, data)
+
+    def close(self):
+        pass
+
+    def _response(self, request, data, status=200):
+        response = requests.Response()
+        response.status_code = status
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['X-Dropbox-Request-Id'] = 'request'
+        response._content = json.dumps(data).encode('utf8')
+        response.request = request
+        response.url = request.url
+        return response
+
+
+class DropboxWatchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dropbox = DropboxInterface()
+        self.dropbox.redis_namespace = 'dropbox-testing'
+        self.dropbox.watch_retry_delay = 0
+        self.dropbox._save_cursor('cursor-1')
+        self.stop = threading.Event()
+        self.cursors = []
+
+    def tearDown(self):
+        self.dropbox._delete_cursor()
+
+    def handler(self):
+        # Like Controller.handle_dropbox_file_change_notification, lists the
+        # changes and saves the next cursor.
+        self.cursors.append(self.dropbox._get_cursor())
+        self.dropbox._save_cursor('cursor-{}'.format(len(self.cursors) + 1))
+
+    def watch(self, results):
+        api = FakeDropboxAPI(results, self.stop)
+        self.dropbox.longpoll_client = api.client()
+        with mock.patch('interfaces.dropbox_interface.time.sleep') as sleep:
+            self.dropbox.watch_changes(self.handler, stop=self.stop)
+        self.sleeps = [c[0][0] for c in sleep.call_args_list]
+        return api.cursors
+
+    def test_watch_changes(self):
+        polled = self.watch([(False, None), (True, None), (False, None),
+                             (True, 1), (False, None)])
+        self.assertEqual(self.cursors, ['cursor-1', 'cursor-2'])
+        # Each poll after a change uses the updated cursor.
+        self.assertEqual(polled, ['cursor-1', 'cursor-1', 'cursor-2',
+                                  'cursor-2', 'cursor-3'])
+        # The backoff Dropbox asked for is waited out before the next poll.
+        self.assertEqual(self.sleeps, [1])
+
+    def test_reset_cursor(self):
+        polled = self.watch([('reset', None), (False, None)])
+        # The handler is run without a cursor to list the whole folder.
+        self.assertEqual(self.cursors, [None])
+        self.assertEqual(polled, ['cursor-1', 'cursor-2'])
+
+
+class FakeDeleteBatchClient:
+    """Stands in for the Dropbox batch delete API.
+
+    Batches run as async jobs that are in progress for the first check.
+    Paths in missing fail with a not_found lookup error.
+    """
+
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+        self.batches = []
+        self.checks = []
+
+    def files_delete_batch(self, entries):
+        self.batches.append([e.path for e in entries])
+        return dropbox.files.DeleteBatchLaunch.async_job_id(
+            str(len(self.batches) - 1))
+
+    def files_delete_batch_check(self, async_job_id):
+        self.checks.append(async_job_id)
+        if self.checks.count(async_job_id) == 1:
+            return dropbox.files.DeleteBatchJobStatus('in_progress')
+        not_found = dropbox.files.DeleteError.path_lookup(
+            dropbox.files.LookupError.not_found)
+        conflict = dropbox.files.DeleteError.path_lookup(
+            dropbox.files.LookupError.restricted_content)
+        entries = []
+        for path in self.batches[int(async_job_id)]:
+            if path in self.missing:
+                entries.append(dropbox.files.DeleteBatchResultEntry.failure(
+                    not_found))
+            elif path.startswith('/restricted'):
+                entries.append(dropbox.files.DeleteBatchResultEntry.failure(
+                    conflict))
+            else:
+                entries.append(dropbox.files.DeleteBatchResultEntry.success(
+                    dropbox.files.DeleteResult(
+                        dropbox.files.FileMetadata(
+                            name=path[1:], id='id:' + path,
+                            path_lower=path))))
+        return dropbox.files.DeleteBatchJobStatus.complete(
+            dropbox.files.DeleteBatchResult(entries))
+
+
+class DropboxDeleteFilesTest(SimpleTestCase):
+
+    def test_delete_files(self):
+        dropbox_interface = DropboxInterface()
+        dropbox_interface.delete_batch_size = 2
+        dropbox_interface.delete_poll_interval = 0
+        client = FakeDeleteBatchClient(missing=['/b.csv'])
+        dropbox_interface.dropbox_client = client
+
+        deleted = dropbox_interface.delete_files(
+            ['/a.csv', '/b.csv', '/restricted.csv'])
+        # Files that were already deleted are gone as well.
+        self.assertEqual(deleted, ['/a.csv', '/b.csv'])
+        self.assertEqual(client.batches,
+                         [['/a.csv', '/b.csv'], ['/restricted.csv']])
+        self.assertEqual(client.checks, ['0', '0', '1', '1'])
+
 class RedisInterfaceTest(TestCase):
     pass
 
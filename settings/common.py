@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.10/ref/settings/
 """
 
-import os
+import os, tempfile
+
+from celery.schedules import crontab
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -171,6 +173,12 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Montreal'
+CELERY_BEAT_SCHEDULE = {
+    'delete-expired-files': {
+        'task': 'dropbox_import.tasks.delete_expired_files',
+        'schedule': crontab(hour=3, minute=0),
+    },
+}
 
 # Cache
 CACHES = {
@@ -185,3 +193,34 @@ CACHES = {
 # Sessions
 SESSION_ENGINE = "django.contrib.sessions.backends.db"
 SESSION_CACHE_ALIAS = "default"
+
+# Shopify
+# Version of the Admin API used by ShopifyClient, Shopify supports each
+# version for at least a year after its release.
+SHOPIFY_API_VERSION = '2024-01'
+
+# Inventory export
+# Delta exports only update the variants whose quantity changed since the last
+# export. Every variant is updated when the last full export is older than
+# this.
+INVENTORY_FULL_SYNC_HOURS = 24
+# Inventory files are parsed into columns with NumPy, otherwise row by row.
+CSV_COLUMNAR_INVENTORY = True
+# Processes used to parse Product files, None for one per CPU. Each celery
+# worker process starts its own pool.
+CSV_PARALLEL_WORKERS = None
+
+# Import file cache
+# Downloaded import files are kept on disk by their Dropbox content hash so
+# retrying an export doesn't download the file again. The least recently used
+# files are removed once the cache is over the max size in bytes.
+IMPORT_FILE_CACHE_DIR = os.environ.get(
+    'IMPORT_FILE_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'theia-api', 'import_files'))
+IMPORT_FILE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# Dropbox retention
+# Import files older than this are deleted from Dropbox with their ImportFiles,
+# ImportJobs, and log entries. The newest file of each company and export type
+# is always kept.
+DROPBOX_RETENTION_DAYS = 14